@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+
+OWNER_ID = 1
+SENDER_ID = 1000
+
+class InlineExecutor(Executor):
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:
+            future.set_exception(exc)
+        return future
+
+def synthetic_update(update_id: int, message_id: int, edited: bool):
+    message = {
+        "business_connection_id": "bench",
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": SENDER_ID, "type": "private"},
+        "from": {"id": SENDER_ID, "is_bot": False, "first_name": "Bench", "username": "bench"},
+        "text": f"Synthetic message {message_id}" + (" edited" if edited else "")
+    }
+    if edited:
+        message["edit_date"] = int(time.time())
+        return {"update_id": update_id, "edited_business_message": message}
+    return {"update_id": update_id, "business_message": message}
+
+def percentile(values, fraction: float):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def probe_lag(interval: float, lags, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - started - interval)
+
+async def run(count: int, concurrency: int, edit_ratio: float, inline_db: bool, probe_interval: float):
+    import main
+    from aiogram import types
+
+    if inline_db:
+        main.db._writer_executor = main.db._reader_executor = InlineExecutor()
+
+    await main.db.connect()
+    await main.db.save_connection("bench", OWNER_ID)
+    await main.db.toggle_setting(OWNER_ID, "digest_mode")
+
+    edit_every = round(1 / edit_ratio) if edit_ratio else 0
+    updates = []
+    message_id = 0
+    for update_id in range(1, count + 1):
+        if edit_every and update_id % edit_every == 0 and message_id:
+            updates.append(synthetic_update(update_id, message_id - concurrency if message_id > concurrency else 1, True))
+        else:
+            message_id += 1
+            updates.append(synthetic_update(update_id, message_id, False))
+    updates = iter(types.Update.model_validate(update, context={"bot": main.bot}) for update in updates)
+
+    lags = []
+    latencies = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_lag(probe_interval, lags, stop))
+
+    async def worker():
+        for update in updates:
+            started = time.perf_counter()
+            await main.dp.feed_update(main.bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await main.db.flush()
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await probe
+    await main.db.close()
+
+    latencies.sort()
+    lags.sort()
+    mode = "inline database calls" if inline_db else "offloaded database calls"
+    print(f"{count} updates, concurrency {concurrency}, {mode}: {count / elapsed:.0f} updates/s")
+    print(
+        f"handler latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms, "
+        f"max {latencies[-1] * 1000:.2f} ms"
+    )
+    print(
+        f"event loop lag ({len(lags)} probes every {probe_interval * 1000:.0f} ms) "
+        f"p50 {percentile(lags, 0.5) * 1000:.2f} ms, "
+        f"p99 {percentile(lags, 0.99) * 1000:.2f} ms, "
+        f"max {lags[-1] * 1000:.2f} ms"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Feed synthetic business updates through the Dispatcher and probe event loop lag")
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--edit-ratio", type=float, default=0.2)
+    parser.add_argument("--commit-delay", type=float, default=0, help="extra milliseconds per write transaction, simulating a slow fsync")
+    parser.add_argument("--inline-db", action="store_true", help="run database calls on the event loop thread")
+    parser.add_argument("--probe-interval", type=float, default=5, help="milliseconds between event loop lag probes")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.update(TOKEN="123456:bench", USER_ID=str(OWNER_ID), WEBHOOK_URL="", DATABASE_URL="", DIGEST_WINDOW="3600")
+    os.chdir(tempfile.mkdtemp(prefix="spybot-bench-"))
+
+    import database
+
+    class SlowCommitPool(database.ConnectionPool):
+        @contextmanager
+        def writer(self):
+            with super().writer() as conn:
+                yield conn
+            time.sleep(args.commit_delay / 1000)
+
+    database.ConnectionPool = SlowCommitPool
+    asyncio.run(run(args.count, args.concurrency, args.edit_ratio, args.inline_db, args.probe_interval / 1000))
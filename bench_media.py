@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+def flat_path_for(key: str, extension: str) -> str:
+    return f"media/{key}{extension}"
+
+def timed(action):
+    started = time.perf_counter()
+    result = action()
+    return time.perf_counter() - started, result
+
+def create_files(paths):
+    directories = set()
+    for path in paths:
+        directory = os.path.dirname(path)
+        if directory not in directories:
+            os.makedirs(directory, exist_ok=True)
+            directories.add(directory)
+        open(path, "wb").close()
+
+def list_files(root: str):
+    count = 0
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    count += 1
+    return count
+
+def lookup_files(paths):
+    return sum(os.path.exists(path) for path in paths)
+
+def run(layout: str, path_for, count: int, lookups: int):
+    keys = [f"AgADBAAD{index:010d}" for index in range(count)]
+    paths = [path_for(key, ".jpg") for key in keys]
+    rng = random.Random(0)
+    hits = [paths[rng.randrange(count)] for _ in range(lookups)]
+    misses = [path_for(f"missing{index}", ".jpg") for index in range(lookups)]
+
+    create_time, _ = timed(lambda: create_files(paths))
+    list_time, listed = timed(lambda: list_files("media"))
+    hit_time, found = timed(lambda: lookup_files(hits))
+    miss_time, _ = timed(lambda: lookup_files(misses))
+    directory_time, _ = timed(lambda: len(os.listdir(os.path.dirname(hits[0]))))
+    assert listed == count and found == lookups
+
+    print(
+        f"{layout:8} create {create_time:7.2f} s | list all {list_time:6.2f} s | "
+        f"list one directory {directory_time * 1000:8.2f} ms | "
+        f"exists hit {hit_time / lookups * 1e6:6.2f} us | miss {miss_time / lookups * 1e6:6.2f} us"
+    )
+    shutil.rmtree("media")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare flat and sharded media directory layouts")
+    parser.add_argument("--files", type=int, default=500000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from utils import media_path_for
+
+    workdir = tempfile.mkdtemp(prefix="spybot-bench-")
+    os.chdir(workdir)
+    print(f"{args.files} files in {workdir}")
+    try:
+        run("flat", flat_path_for, args.files, args.lookups)
+        run("sharded", media_path_for, args.files, args.lookups)
+    finally:
+        os.chdir("/")
+        shutil.rmtree(workdir)
@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from aiogram import types
+
+OWNER_ID = 1
+CHAT_ID = 1000
+EDIT_EVERY = 5
+
+class ConnectPerCallPool:
+    def __init__(self, db_path: str, readers: int = 4):
+        self.db_path = db_path
+        self._write_lock = threading.Lock()
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+    @contextmanager
+    def reader(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+def synthetic_message(message_id: int, text: str = None, photo: bool = False):
+    values = dict(
+        message_id=message_id,
+        date=datetime.now(timezone.utc),
+        chat=types.Chat(id=CHAT_ID, type="private"),
+        from_user=types.User(id=CHAT_ID, is_bot=False, first_name="Bench", username="bench"),
+        text=text or f"Synthetic message {message_id}"
+    )
+    if photo:
+        values["photo"] = [types.PhotoSize(file_id=f"photo-{message_id}", file_unique_id=f"unique-{message_id}", width=1, height=1, file_size=100)]
+    return types.Message(**values)
+
+def percentile(values, fraction: float):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def open_database(args):
+    import database
+
+    if args.connect_per_call:
+        database.ConnectionPool = ConnectPerCallPool
+    db = database.Database("messages.db", batch_size=args.batch_size)
+    db.message_cache.max_entries = args.cache_entries
+    return db
+
+def describe(args):
+    pool = "connect per call" if args.connect_per_call else "pooled connections"
+    return f"{pool}, batch size {args.batch_size}, cache {args.cache_entries}"
+
+async def handle_update(db, message_id: int):
+    await db.save_message(OWNER_ID, synthetic_message(message_id))
+    if message_id % EDIT_EVERY == 0:
+        old_message = await db.get_message(OWNER_ID, CHAT_ID, message_id - EDIT_EVERY + 1)
+        db.get_settings(OWNER_ID)
+        await db.save_message_action(OWNER_ID, CHAT_ID, old_message['message_id'], 'edit', old_message['text'], "edited")
+
+async def ingest(args):
+    db = open_database(args)
+    interval = 60 / args.rate
+    latencies = []
+
+    async def timed(message_id: int):
+        started = time.perf_counter()
+        await handle_update(db, message_id)
+        latencies.append(time.perf_counter() - started)
+
+    tasks = []
+    started = time.perf_counter()
+    for message_id in range(1, args.count + 1):
+        delay = started + (message_id - 1) * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed(message_id)))
+    await asyncio.gather(*tasks)
+    await db.flush()
+    elapsed = time.perf_counter() - started
+    await db.close()
+
+    latencies.sort()
+    print(f"{args.count} updates at {args.rate} msgs/min ({describe(args)}) in {elapsed:.1f} s")
+    print(
+        f"per-update latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+        f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms, "
+        f"max {latencies[-1] * 1000:.2f} ms"
+    )
+
+async def burst(args):
+    db = open_database(args)
+    message_ids = iter(range(1, args.count + 1))
+
+    async def worker():
+        for message_id in message_ids:
+            await db.save_message(OWNER_ID, synthetic_message(message_id))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    await db.flush()
+    elapsed = time.perf_counter() - started
+    stored = (await db.get_stats(OWNER_ID))["total_messages"]
+    await db.close()
+
+    print(f"{args.count} messages ({describe(args)}) stored {stored} in {elapsed:.2f} s: {args.count / elapsed:.0f} msgs/s")
+
+async def delete(args):
+    message_ids = list(range(1, args.ids + 1))
+    db = open_database(args)
+    for message_id in message_ids:
+        await db.save_message(OWNER_ID, synthetic_message(message_id, photo=message_id % args.media_every == 0))
+    await db.flush()
+
+    media_paths = []
+    for message in (await db.get_messages(OWNER_ID, CHAT_ID, message_ids)).values():
+        for _, media_path, _ in message["media_files"]:
+            os.makedirs(os.path.dirname(media_path), exist_ok=True)
+            with open(media_path, "wb") as file:
+                file.write(b"x" * 100)
+            await db.set_media_status(media_path, 'done', 100)
+            media_paths.append(media_path)
+    await db.close()
+
+    db = open_database(args)
+    started = time.perf_counter()
+    if args.per_id:
+        for message_id in message_ids:
+            await db.get_message(OWNER_ID, CHAT_ID, message_id)
+            await db.delete_message(OWNER_ID, CHAT_ID, message_id)
+    else:
+        await db.get_messages(OWNER_ID, CHAT_ID, message_ids)
+        await db.delete_messages(OWNER_ID, CHAT_ID, message_ids)
+    elapsed = time.perf_counter() - started
+    await db.close()
+
+    mode = "one id at a time" if args.per_id else "bulk"
+    remaining = sum(os.path.exists(media_path) for media_path in media_paths)
+    print(
+        f"{len(message_ids)}-id deletion event, {len(media_paths)} with media ({mode}, {describe(args)}): "
+        f"{elapsed * 1000:.1f} ms, {len(media_paths) - remaining} files removed"
+    )
+
+SCENARIOS = {
+    "ingest": ingest,
+    "burst": burst,
+    "delete": delete
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure Database throughput and latency on synthetic messages")
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--count", type=int, default=3000)
+    parser.add_argument("--rate", type=int, default=10000, help="messages per minute for the ingest scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent writers for the burst scenario")
+    parser.add_argument("--ids", type=int, default=1000, help="message ids per event for the delete scenario")
+    parser.add_argument("--media-every", type=int, default=10, help="every n-th message in the delete scenario has a photo")
+    parser.add_argument("--per-id", action="store_true", help="fetch and delete ids one at a time, as before the bulk path")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--cache-entries", type=int, default=10000)
+    parser.add_argument("--connect-per-call", action="store_true", help="open a new SQLite connection for every query, as before the pool")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="spybot-bench-"))
+    asyncio.run(SCENARIOS[args.scenario](args))
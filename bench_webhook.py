@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+BENCH_SECRET = "bench-secret"
+
+def synthetic_update(update_id: int):
+    return {
+        "update_id": update_id,
+        "business_message": {
+            "business_connection_id": "bench",
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 1000, "type": "private"},
+            "from": {"id": 1000, "is_bot": False, "first_name": "Bench", "username": "bench"},
+            "text": f"Synthetic message {update_id}"
+        }
+    }
+
+def percentile(values, fraction: float):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run(count: int, concurrency: int):
+    import main
+
+    app = main.build_app(main.dp, main.bot, main.limiter, "/webhook", BENCH_SECRET, handle_in_background=False)
+    server = TestServer(app)
+    await server.start_server()
+    await main.db.save_connection("bench", 1)
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": BENCH_SECRET}
+    url = str(server.make_url("/webhook"))
+    latencies = []
+    update_ids = iter(range(1, count + 1))
+
+    async with ClientSession() as session:
+        async with session.post(url, json=synthetic_update(0), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+            print(f"Wrong secret token: HTTP {response.status}")
+
+        async def worker():
+            for update_id in update_ids:
+                started = time.perf_counter()
+                async with session.post(url, json=synthetic_update(update_id), headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        print(f"Update {update_id}: HTTP {response.status}")
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    await server.close()
+
+    latencies.sort()
+    print(f"{count} updates, concurrency {concurrency}: {count / elapsed:.0f} updates/s")
+    print(
+        f"latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+        f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms, "
+        f"max {latencies[-1] * 1000:.2f} ms"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post synthetic updates to a local webhook server")
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.update(TOKEN="123456:bench", USER_ID="1", WEBHOOK_URL="", DATABASE_URL="")
+    os.chdir(tempfile.mkdtemp(prefix="spybot-bench-"))
+    asyncio.run(run(args.count, args.concurrency))
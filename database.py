@@ -1,606 +1,1323 @@
 import sqlite3
 import os
+import json
+import sys
+import time
+import queue
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from aiogram import types
 
-def get_extension_from_mime(mime_type: str) -> str:
-    mime_to_ext = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png',
-        'image/gif': '.gif',
-        'video/mp4': '.mp4',
-        'audio/mpeg': '.mp3',
-        'audio/ogg': '.ogg',
-        'application/pdf': '.pdf'
-    }
-    return mime_to_ext.get(mime_type, '')
-    
-def get_file_extension(file_name: str) -> str:
-    if not file_name:
-        return ''
-    parts = file_name.rsplit('.', 1)
-    if len(parts) > 1:
-        return f".{parts[1].lower()}"
-    return ''
-
-class Database:
-    def __init__(self, db_path="messages.db"):
-        self.db_path = db_path
-        self._create_tables()
-        
-    def _create_tables(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT UNIQUE,
-            first_seen TEXT
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            chat_id INTEGER,
-            message_id INTEGER,
-            user_id INTEGER,
-            text TEXT,
-            date TEXT,
-            is_forwarded INTEGER DEFAULT 0,
-            forward_from TEXT,
-            latitude REAL,
-            longitude REAL,
-            PRIMARY KEY (chat_id, message_id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS message_actions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            message_id INTEGER,
-            action_type TEXT,
-            old_text TEXT,
-            new_text TEXT,
-            action_date TEXT,
-            FOREIGN KEY (chat_id, message_id) REFERENCES messages(chat_id, message_id)
+from storage import CLEANUP_BATCH_SIZE, STATS_TABLES, Storage, remove_empty_dirs
+from utils import MEDIA_DIR
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA recursive_triggers=ON",
+)
+
+SQLITE_CHUNK_SIZE = 500
+
+MESSAGE_COLUMNS = (
+    'owner_id',
+    'chat_id',
+    'message_id',
+    'user_id',
+    'text',
+    'date',
+    'is_forwarded',
+    'forward_from',
+    'latitude',
+    'longitude',
+    'media_group_id'
+)
+
+def _table_columns(cursor, table: str):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+def _migration_1(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT UNIQUE,
+        first_seen TEXT
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        chat_id INTEGER,
+        message_id INTEGER,
+        user_id INTEGER,
+        text TEXT,
+        date TEXT,
+        is_forwarded INTEGER DEFAULT 0,
+        forward_from TEXT,
+        PRIMARY KEY (chat_id, message_id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS message_actions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        message_id INTEGER,
+        action_type TEXT,
+        old_text TEXT,
+        new_text TEXT,
+        action_date TEXT,
+        FOREIGN KEY (chat_id, message_id) REFERENCES messages(chat_id, message_id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media_files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        message_id INTEGER,
+        file_id TEXT,
+        media_type TEXT,
+        media_path TEXT,
+        FOREIGN KEY (chat_id, message_id) REFERENCES messages(chat_id, message_id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value INTEGER
+    )
+    ''')
+
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('notify_edited', 1)")
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('notify_deleted', 1)")
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('ignore_changes_below', 0)")
+
+def _migration_2(cursor):
+    columns = _table_columns(cursor, "messages")
+    if 'latitude' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN latitude REAL")
+    if 'longitude' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN longitude REAL")
+
+def _migration_3(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_actions_message ON message_actions (chat_id, message_id, action_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_message ON media_files (chat_id, message_id)")
+
+def _migration_4(cursor):
+    if 'status' not in _table_columns(cursor, "media_files"):
+        cursor.execute("ALTER TABLE media_files ADD COLUMN status TEXT DEFAULT 'done'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_path ON media_files (media_path)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_status ON media_files (status)")
+
+def _migration_5(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media_store (
+        file_unique_id TEXT PRIMARY KEY,
+        media_path TEXT,
+        ref_count INTEGER DEFAULT 0
+    )
+    ''')
+    if 'file_unique_id' not in _table_columns(cursor, "media_files"):
+        cursor.execute("ALTER TABLE media_files ADD COLUMN file_unique_id TEXT")
+
+def _migration_6(cursor):
+    if 'size' not in _table_columns(cursor, "media_store"):
+        cursor.execute("ALTER TABLE media_store ADD COLUMN size INTEGER")
+
+def _migration_7(cursor):
+    if 'media_group_id' not in _table_columns(cursor, "messages"):
+        cursor.execute("ALTER TABLE messages ADD COLUMN media_group_id TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_media_group ON messages (chat_id, media_group_id)")
+
+def _migration_8(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        media_files TEXT,
+        text TEXT,
+        created_at TEXT
+    )
+    ''')
+
+def _migration_9(cursor):
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('digest_mode', 0)")
+
+def _legacy_owner():
+    owners = [owner for owner in os.getenv("USER_ID", "").split(",") if owner.strip()]
+    return int(owners[0]) if owners else 0
+
+def _migration_10(cursor):
+    owner_id = _legacy_owner()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS business_connections (
+        id TEXT PRIMARY KEY,
+        owner_id INTEGER,
+        is_enabled INTEGER DEFAULT 1
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE messages_partitioned (
+        owner_id INTEGER,
+        chat_id INTEGER,
+        message_id INTEGER,
+        user_id INTEGER,
+        text TEXT,
+        date TEXT,
+        is_forwarded INTEGER DEFAULT 0,
+        forward_from TEXT,
+        latitude REAL,
+        longitude REAL,
+        media_group_id TEXT,
+        PRIMARY KEY (owner_id, chat_id, message_id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+    cursor.execute('''
+    INSERT INTO messages_partitioned
+    SELECT ?, chat_id, message_id, user_id, text, date, is_forwarded, forward_from, latitude, longitude, media_group_id
+    FROM messages
+    ''', (owner_id,))
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_partitioned RENAME TO messages")
+
+    for table in ("message_actions", "media_files", "outbox"):
+        if 'owner_id' not in _table_columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN owner_id INTEGER")
+        cursor.execute(f"UPDATE {table} SET owner_id = ?", (owner_id,))
+
+    if owner_id:
+        cursor.execute(
+            "INSERT OR REPLACE INTO settings (key, value) SELECT ? || ':' || key, value FROM settings WHERE instr(key, ':') = 0",
+            (owner_id,)
         )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS media_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            message_id INTEGER,
-            file_id TEXT,
-            media_type TEXT,
-            media_path TEXT,
-            FOREIGN KEY (chat_id, message_id) REFERENCES messages(chat_id, message_id)
+        cursor.execute("DELETE FROM settings WHERE instr(key, ':') = 0")
+        cursor.executemany(
+            "INSERT INTO settings (key, value) VALUES (?, ?)",
+            [('notify_edited', 1), ('notify_deleted', 1), ('ignore_changes_below', 0), ('digest_mode', 0)]
         )
-        ''')
 
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value INTEGER
-        )
-        ''')
-
-        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('notify_edited', 1)")
-        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('notify_deleted', 1)")
-        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('ignore_changes_below', 0)")
-        
-        conn.commit()
-        conn.close()
-        
-    async def save_message(self, message: types.Message):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT OR REPLACE INTO users (id, username, first_seen) VALUES (?, ?, ?)",
-            (
-                message.from_user.id,
-                message.from_user.username,
-                datetime.now().isoformat()
+    cursor.execute("DROP INDEX IF EXISTS idx_message_actions_message")
+    cursor.execute("DROP INDEX IF EXISTS idx_media_files_message")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (owner_id, user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (owner_id, message_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_media_group ON messages (owner_id, chat_id, media_group_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_actions_message ON message_actions (owner_id, chat_id, message_id, action_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_message ON media_files (owner_id, chat_id, message_id)")
+
+def _migration_11(cursor):
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text,
+        content='messages',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS message_actions_fts USING fts5(
+        old_text,
+        content='message_actions', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+
+    cursor.executescript('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS message_actions_fts_insert AFTER INSERT ON message_actions BEGIN
+        INSERT INTO message_actions_fts (rowid, old_text) VALUES (new.id, new.old_text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS message_actions_fts_delete AFTER DELETE ON message_actions BEGIN
+        INSERT INTO message_actions_fts (message_actions_fts, rowid, old_text) VALUES ('delete', old.id, old.old_text);
+    END;
+    ''')
+
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO message_actions_fts (message_actions_fts) VALUES ('rebuild')")
+
+def _migration_12(cursor):
+    if 'user_id' not in _table_columns(cursor, "message_actions"):
+        cursor.execute("ALTER TABLE message_actions ADD COLUMN user_id INTEGER")
+    cursor.execute('''
+    UPDATE message_actions SET user_id = (
+        SELECT m.user_id FROM messages m
+        WHERE m.owner_id = message_actions.owner_id AND m.chat_id = message_actions.chat_id AND m.message_id = message_actions.message_id
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_actions_user ON message_actions (owner_id, user_id, action_date, id)")
+
+def _migration_13(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_stats (
+        owner_id INTEGER,
+        user_id INTEGER,
+        messages INTEGER DEFAULT 0,
+        actions INTEGER DEFAULT 0,
+        media INTEGER DEFAULT 0,
+        PRIMARY KEY (owner_id, user_id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS owner_stats (
+        owner_id INTEGER PRIMARY KEY,
+        messages INTEGER DEFAULT 0,
+        media INTEGER DEFAULT 0
+    )
+    ''')
+
+    cursor.executescript('''
+    CREATE TRIGGER IF NOT EXISTS stats_message_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO user_stats (owner_id, user_id, messages) VALUES (new.owner_id, new.user_id, 1)
+        ON CONFLICT (owner_id, user_id) DO UPDATE SET messages = messages + 1;
+        INSERT INTO owner_stats (owner_id, messages) VALUES (new.owner_id, 1)
+        ON CONFLICT (owner_id) DO UPDATE SET messages = messages + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stats_message_delete AFTER DELETE ON messages BEGIN
+        UPDATE user_stats SET messages = messages - 1 WHERE owner_id = old.owner_id AND user_id = old.user_id;
+        UPDATE owner_stats SET messages = messages - 1 WHERE owner_id = old.owner_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stats_action_insert AFTER INSERT ON message_actions WHEN new.user_id IS NOT NULL BEGIN
+        INSERT INTO user_stats (owner_id, user_id, actions) VALUES (new.owner_id, new.user_id, 1)
+        ON CONFLICT (owner_id, user_id) DO UPDATE SET actions = actions + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stats_action_delete AFTER DELETE ON message_actions WHEN old.user_id IS NOT NULL BEGIN
+        UPDATE user_stats SET actions = actions - 1 WHERE owner_id = old.owner_id AND user_id = old.user_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stats_media_insert AFTER INSERT ON media_files BEGIN
+        INSERT INTO user_stats (owner_id, user_id, media)
+        SELECT owner_id, user_id, 1 FROM messages
+        WHERE owner_id = new.owner_id AND chat_id = new.chat_id AND message_id = new.message_id
+        ON CONFLICT (owner_id, user_id) DO UPDATE SET media = media + 1;
+        INSERT INTO owner_stats (owner_id, media) VALUES (new.owner_id, 1)
+        ON CONFLICT (owner_id) DO UPDATE SET media = media + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS stats_media_delete AFTER DELETE ON media_files BEGIN
+        UPDATE user_stats SET media = media - 1
+        WHERE owner_id = old.owner_id AND user_id = (
+            SELECT user_id FROM messages WHERE owner_id = old.owner_id AND chat_id = old.chat_id AND message_id = old.message_id
+        );
+        UPDATE owner_stats SET media = media - 1 WHERE owner_id = old.owner_id;
+    END;
+    ''')
+
+    _rebuild_stats(cursor)
+
+def _rebuild_stats(cursor):
+    drift = 0
+    for table, (keys, counters, query) in STATS_TABLES.items():
+        columns = ', '.join(keys + counters)
+        stored = f"SELECT {columns} FROM {table} WHERE {' OR '.join(f'{counter} != 0' for counter in counters)}"
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT {', '.join(keys)} FROM (SELECT * FROM ({query}) EXCEPT {stored}) AS missing
+                UNION
+                SELECT {', '.join(keys)} FROM ({stored} EXCEPT SELECT * FROM ({query})) AS stale
             )
-        )
-        
-        is_forwarded = 0
-        forward_from = ""
-        
-        if message.forward_from:
-            is_forwarded = 1
-            if message.forward_from.username:
-                forward_from = f"@{message.forward_from.username}"
-            else:
-                forward_from = message.forward_from.full_name
-        elif message.forward_from_chat:
-            is_forwarded = 1
-            if message.forward_from_chat.username:
-                forward_from = f"@{message.forward_from_chat.username}"
+        """)
+        drift += cursor.fetchone()[0]
+
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f"INSERT INTO {table} ({columns}) {query}")
+    return drift
+
+def _migration_14(cursor):
+    cursor.execute('''
+    CREATE TABLE users_identity (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_seen TEXT
+    )
+    ''')
+    cursor.execute("INSERT INTO users_identity SELECT id, username, first_seen FROM users")
+    cursor.execute("DROP TABLE users")
+    cursor.execute("ALTER TABLE users_identity RENAME TO users")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS username_history (
+        user_id INTEGER,
+        username TEXT,
+        first_seen TEXT,
+        PRIMARY KEY (user_id, username)
+    )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO username_history SELECT id, username, first_seen FROM users WHERE username IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_username_history_username ON username_history (username COLLATE NOCASE)")
+
+def _migration_15(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_store_path ON media_store (media_path)")
+
+def _migration_16(cursor):
+    cursor.execute("ALTER TABLE outbox ADD COLUMN held_paths TEXT")
+
+def _resolve_user(cursor, owner_id: int, user: str):
+    user = user.lstrip("@")
+    if user.isdigit():
+        cursor.execute("SELECT user_id FROM user_stats WHERE owner_id = ? AND user_id = ?", (owner_id, int(user)))
+    else:
+        cursor.execute("""
+            SELECT h.user_id FROM username_history h
+            JOIN users u ON u.id = h.user_id
+            JOIN user_stats s ON s.owner_id = ? AND s.user_id = h.user_id
+            WHERE h.username = ? COLLATE NOCASE
+            ORDER BY u.username = h.username COLLATE NOCASE DESC, h.first_seen DESC
+            LIMIT 1
+        """, (owner_id, user))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _fts_query(query: str):
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+    _migration_11,
+    _migration_12,
+    _migration_13,
+    _migration_14,
+    _migration_15,
+    _migration_16,
+]
+
+def _offload(kind: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if kind == "write":
+                self._start_flush()
+                executor = self._writer_executor
             else:
-                forward_from = message.forward_from_chat.title
-        elif message.forward_sender_name:
-            is_forwarded = 1
-            forward_from = message.forward_sender_name
-        
-        text = message.md_text or message.caption or " "
-        
-        latitude = None
-        longitude = None
-        if message.location and not message.location.live_period:
-            latitude = message.location.latitude
-            longitude = message.location.longitude
-            if not text or text == " ":
-                text = f"📍 {latitude}, {longitude}"
-        
-        cursor.execute("PRAGMA table_info(messages)")
-        columns = [row[1] for row in cursor.fetchall()]
-        placeholders = ','.join(['?' for _ in columns])
-        
-        values = {
-            'chat_id': message.chat.id,
-            'message_id': message.message_id,
-            'user_id': message.from_user.id,
-            'text': text,
-            'date': message.date.isoformat(),
-            'is_forwarded': is_forwarded,
-            'forward_from': forward_from,
-            'latitude': latitude,
-            'longitude': longitude
-        }
-        
-        ordered_values = [values.get(column, None) for column in columns]
-        
-        cursor.execute(
-            f"INSERT OR REPLACE INTO messages VALUES ({placeholders})",
-            ordered_values
+                executor = self._reader_executor
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(func, self, *args, **kwargs))
+        return wrapper
+    return decorator
+
+class ConnectionPool:
+    def __init__(self, db_path: str, readers: int = 4):
+        self.db_path = db_path
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect(query_only=True))
+
+    def _connect(self, query_only: bool = False):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        if query_only:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+class MessageCache:
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 32 * 1024 * 1024, ttl: int = 86400):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(message: dict):
+        size = sys.getsizeof(message)
+        for value in message.values():
+            size += sys.getsizeof(value)
+        for media in message["media_files"]:
+            size += sum(sys.getsizeof(part) for part in media)
+        return size
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, _, message = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(message)
+
+    def put(self, key, message: dict):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            size = self._sizeof(message)
+            self._entries[key] = (time.monotonic() + self.ttl, size, message)
+            self.bytes += size
+
+            while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def update_text(self, key, text: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+
+            expires_at, size, message = entry
+            message = dict(message, text=text)
+            new_size = self._sizeof(message)
+            self._entries[key] = (expires_at, new_size, message)
+            self.bytes += new_size - size
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def evict(self, predicate):
+        with self._lock:
+            for key in [key for key, (_, _, message) in self._entries.items() if predicate(message)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+class Database(Storage):
+    def __init__(self, db_path="messages.db", readers=4, batch_size=100, flush_interval=0.005,
+                 lazy_media=False, prefetch_types=()):
+        super().__init__(lazy_media, prefetch_types)
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, readers)
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._reader_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._pending_keys = set()
+        self._inflight = {}
+        self._flush_handle = None
+        self.message_cache = MessageCache()
+        self._migrate()
+
+    async def close(self):
+        await self.flush()
+        self._writer_executor.shutdown(wait=True)
+        self._reader_executor.shutdown(wait=True)
+        self.pool.close()
+
+    def cache_stats(self):
+        return self.message_cache.stats()
+
+    def _migrate(self):
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS, start=1):
+                if number <= version:
+                    continue
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+
+            self._load_schema(cursor)
+            self.settings.load(cursor.execute("SELECT key, value FROM settings").fetchall())
+            self.connections = {
+                connection_id: owner_id if is_enabled else None
+                for connection_id, owner_id, is_enabled in cursor.execute("SELECT id, owner_id, is_enabled FROM business_connections")
+            }
+            self.media_bytes = cursor.execute("SELECT COALESCE(SUM(size), 0) FROM media_store").fetchone()[0]
+
+    def _load_schema(self, cursor):
+        columns = _table_columns(cursor, "messages")
+        self._message_columns = [column for column in MESSAGE_COLUMNS if column in columns]
+        self._insert_message_sql = (
+            f"INSERT OR REPLACE INTO messages ({', '.join(self._message_columns)}) "
+            f"VALUES ({', '.join('?' for _ in self._message_columns)})"
         )
-        
-        media_files = []
-        if message.photo:
-            largest_photo = message.photo[-1]
-            media_files.append(("photo", largest_photo.file_id, '.jpg'))
-        if message.video:
-            ext = get_extension_from_mime(message.video.mime_type) or get_file_extension(message.video.file_name) or '.mp4'
-            media_files.append(("video", message.video.file_id, ext))
-        if message.video_note:
-            media_files.append(("video_note", message.video_note.file_id, '.mp4'))
-        if message.voice:
-            ext = get_extension_from_mime(message.voice.mime_type) or '.ogg'
-            media_files.append(("voice", message.voice.file_id, ext))
-        if message.audio:
-            ext = get_extension_from_mime(message.audio.mime_type) or get_file_extension(message.audio.file_name) or '.mp3'
-            media_files.append(("audio", message.audio.file_id, ext))
-        if message.animation:
-            ext = get_extension_from_mime(message.animation.mime_type) or '.gif'
-            media_files.append(("animation", message.animation.file_id, ext))
-        if message.document and not message.animation:
-            if message.document.mime_type == 'image/gif':
-                media_files.append(("animation", message.document.file_id, '.gif'))
+
+    async def save_message(self, owner_id: int, message: types.Message):
+        user, values, media_rows, saved_media, cached_media = self.parse_message(owner_id, message)
+
+        self.message_cache.put((owner_id, values['chat_id'], values['message_id']), {
+            "owner_id": owner_id,
+            "chat_id": values['chat_id'],
+            "message_id": values['message_id'],
+            "user_id": values['user_id'],
+            "text": values['text'],
+            "date": values['date'],
+            "is_forwarded": bool(values['is_forwarded']),
+            "forward_from": values['forward_from'],
+            "latitude": values['latitude'],
+            "longitude": values['longitude'],
+            "media_group_id": values['media_group_id'],
+            "username": user[1],
+            "media_files": cached_media
+        })
+
+        self._pending.append((user if self._user_changed(user) else None, values, media_rows))
+        self._pending_keys.add((owner_id, values['chat_id'], values['message_id']))
+
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+        return saved_media
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._pending:
+            return
+
+        batch = self._pending
+        keys = self._pending_keys
+        self._pending = []
+        self._pending_keys = set()
+
+        future = asyncio.get_running_loop().run_in_executor(self._writer_executor, self._write_batch, batch)
+        self._inflight[future] = keys
+        future.add_done_callback(self._finish_flush)
+
+    def _finish_flush(self, future):
+        self._inflight.pop(future, None)
+        if not future.cancelled() and future.exception():
+            print(f"{datetime.now()}: Failed to write message batch: {future.exception()}")
+
+    def _is_pending(self, owner_id: int, chat_id: int, message_id: int):
+        key = (owner_id, chat_id, message_id)
+        return key in self._pending_keys or any(key in keys for keys in self._inflight.values())
+
+    async def flush(self):
+        self._start_flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def _write_batch(self, batch):
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+
+            users = [user for user, _, _ in batch if user]
+            cursor.executemany("""
+                INSERT INTO users (id, username, first_seen) VALUES (?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET username = excluded.username WHERE username IS NOT excluded.username
+            """, users)
+            cursor.executemany(
+                "INSERT OR IGNORE INTO username_history (user_id, username, first_seen) VALUES (?, ?, ?)",
+                [user for user in users if user[1]]
+            )
+            cursor.executemany(
+                self._insert_message_sql,
+                [[values[column] for column in self._message_columns] for _, values, _ in batch]
+            )
+
+            for _, _, media_rows in batch:
+                for owner_id, chat_id, message_id, file_id, file_unique_id, media_type, media_path, status in media_rows:
+                    cursor.execute("""
+                        INSERT INTO media_files (owner_id, chat_id, message_id, file_id, file_unique_id, media_type, media_path, status)
+                        SELECT ?, ?, ?, ?, ?, ?, ?, ?
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM media_files
+                            WHERE owner_id = ? AND chat_id = ? AND message_id = ? AND file_unique_id = ?
+                        )
+                    """, (owner_id, chat_id, message_id, file_id, file_unique_id, media_type, media_path, status, owner_id, chat_id, message_id, file_unique_id))
+
+                    if cursor.rowcount:
+                        cursor.execute("""
+                            INSERT INTO media_store (file_unique_id, media_path, ref_count) VALUES (?, ?, 1)
+                            ON CONFLICT (file_unique_id) DO UPDATE SET ref_count = ref_count + 1
+                        """, (file_unique_id, media_path))
+
+    def _release_media(self, cursor, rows, mark_released: bool = True):
+        unused_paths = []
+        references = {}
+        for _, file_unique_id, media_path in rows:
+            if file_unique_id:
+                references[file_unique_id] = references.get(file_unique_id, 0) + 1
             else:
-                ext = get_extension_from_mime(message.document.mime_type) or get_file_extension(message.document.file_name) or ''
-                media_files.append(("document", message.document.file_id, ext))
-        if message.sticker:
-            media_files.append(("sticker", message.sticker.file_id, '.webp'))
-            
-        saved_media = []
-        for media_type, file_id, extension in media_files:
-            if not os.path.exists("media"):
-                os.makedirs("media")
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            media_path = f"media/{timestamp}_{media_type}{extension}"
-            
+                unused_paths.append(media_path)
+
+        cursor.executemany(
+            "UPDATE media_store SET ref_count = ref_count - ? WHERE file_unique_id = ?",
+            [(count, file_unique_id) for file_unique_id, count in references.items()]
+        )
+        for file_unique_id in references:
             cursor.execute(
-                "INSERT INTO media_files (chat_id, message_id, file_id, media_type, media_path) VALUES (?, ?, ?, ?, ?)",
-                (message.chat.id, message.message_id, file_id, media_type, media_path)
+                "SELECT media_path, size FROM media_store WHERE file_unique_id = ? AND ref_count <= 0",
+                (file_unique_id,)
+            )
+            for media_path, size in cursor.fetchall():
+                unused_paths.append(media_path)
+                self.media_bytes -= size or 0
+        cursor.executemany(
+            "DELETE FROM media_store WHERE file_unique_id = ? AND ref_count <= 0",
+            [(file_unique_id,) for file_unique_id in references]
+        )
+
+        if mark_released:
+            cursor.executemany(
+                "UPDATE media_files SET status = 'released' WHERE id = ?",
+                [(row[0],) for row in rows]
             )
-            saved_media.append((media_path, file_id))
-        
-        conn.commit()
-        conn.close()
-        return saved_media
 
-    def save_message_action(self, chat_id: int, message_id: int, action_type: str, old_text: str, new_text: str = None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        return unused_paths
+
+    def _insert_action(self, conn, owner_id: int, chat_id: int, message_id: int, action_type: str, old_text: str, new_text: str = None):
         if action_type == 'edit':
-            cursor.execute(
-                "UPDATE messages SET text = ? WHERE chat_id = ? AND message_id = ?",
-                (new_text, chat_id, message_id)
+            conn.execute(
+                "UPDATE messages SET text = ? WHERE owner_id = ? AND chat_id = ? AND message_id = ?",
+                (new_text, owner_id, chat_id, message_id)
             )
-        
-        cursor.execute(
-            "INSERT INTO message_actions (chat_id, message_id, action_type, old_text, new_text, action_date) VALUES (?, ?, ?, ?, ?, ?)",
-            (chat_id, message_id, action_type, old_text, new_text, datetime.now().isoformat())
-        )
-        
-        conn.commit()
-        conn.close()
-
-    def get_message(self, chat_id: int, message_id: int):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT m.*, u.username 
-            FROM messages m
-            JOIN users u ON m.user_id = u.id
-            WHERE m.chat_id = ? AND m.message_id = ?
-        """, (chat_id, message_id))
-        
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
-            return None
-            
-        cursor.execute(
-            "SELECT media_type, media_path, file_id FROM media_files WHERE chat_id = ? AND message_id = ?",
-            (chat_id, message_id)
-        )
-        
-        media_files = cursor.fetchall()
-        conn.close()
-            
-        return {
-            "chat_id": row[0],
-            "message_id": row[1],
-            "user_id": row[2],
-            "text": row[3],
-            "date": row[4],
-            "is_forwarded": bool(row[5]),
-            "forward_from": row[6],
-            "latitude": row[7],
-            "longitude": row[8],
-            "username": row[9],
-            "media_files": media_files
-        }
 
-    def get_user_actions(self, username: str, limit: int = 5):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        user_row = cursor.fetchone()
-        if not user_row:
-            conn.close()
-            return None, []
-            
-        user_id = user_row[0]
-        
-        cursor.execute("""
-            SELECT 
-                ma.action_type,
-                ma.old_text,
-                ma.new_text,
-                ma.action_date,
-                m.is_forwarded,
-                m.forward_from,
-                m.chat_id,
-                m.message_id,
-                m.latitude,
-                m.longitude
-            FROM message_actions ma
-            JOIN messages m ON ma.chat_id = m.chat_id AND ma.message_id = m.message_id
-            WHERE m.user_id = ?
-            ORDER BY ma.action_date DESC
-            LIMIT ?
-        """, (user_id, limit))
-        
+        conn.execute("""
+            INSERT INTO message_actions (owner_id, chat_id, message_id, user_id, action_type, old_text, new_text, action_date)
+            VALUES (?, ?, ?, (SELECT user_id FROM messages WHERE owner_id = ? AND chat_id = ? AND message_id = ?), ?, ?, ?, ?)
+        """, (owner_id, chat_id, message_id, owner_id, chat_id, message_id, action_type, old_text, new_text, datetime.now().isoformat()))
+
+    @_offload("write")
+    def save_message_action(self, owner_id: int, chat_id: int, message_id: int, action_type: str, old_text: str, new_text: str = None):
+        with self.pool.writer() as conn:
+            self._insert_action(conn, owner_id, chat_id, message_id, action_type, old_text, new_text)
+
+        if action_type == 'edit':
+            self.message_cache.update_text((owner_id, chat_id, message_id), new_text)
+
+    async def get_messages(self, owner_id: int, chat_id: int, message_ids):
+        messages = {}
+        missing = []
+        for message_id in message_ids:
+            cached = self.message_cache.get((owner_id, chat_id, message_id))
+            if cached is not None:
+                messages[message_id] = cached
+            else:
+                missing.append(message_id)
+
+        if not missing:
+            return messages
+
+        if any(self._is_pending(owner_id, chat_id, message_id) for message_id in missing):
+            await self.flush()
+
+        for message_id, message in (await self._get_messages(owner_id, chat_id, missing)).items():
+            self.message_cache.put((owner_id, chat_id, message_id), message)
+            messages[message_id] = message
+
+        return messages
+
+    @_offload("read")
+    def _get_messages(self, owner_id: int, chat_id: int, message_ids):
+        messages = {}
+
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+
+            for start in range(0, len(message_ids), SQLITE_CHUNK_SIZE):
+                chunk = message_ids[start:start + SQLITE_CHUNK_SIZE]
+                placeholders = ','.join('?' for _ in chunk)
+
+                cursor.execute(f"""
+                    SELECT m.chat_id, m.message_id, m.user_id, m.text, m.date,
+                           m.is_forwarded, m.forward_from, m.latitude, m.longitude, m.media_group_id, u.username
+                    FROM messages m
+                    JOIN users u ON m.user_id = u.id
+                    WHERE m.owner_id = ? AND m.chat_id = ? AND m.message_id IN ({placeholders})
+                """, (owner_id, chat_id, *chunk))
+
+                for row in cursor.fetchall():
+                    messages[row[1]] = {
+                        "owner_id": owner_id,
+                        "chat_id": row[0],
+                        "message_id": row[1],
+                        "user_id": row[2],
+                        "text": row[3],
+                        "date": row[4],
+                        "is_forwarded": bool(row[5]),
+                        "forward_from": row[6],
+                        "latitude": row[7],
+                        "longitude": row[8],
+                        "media_group_id": row[9],
+                        "username": row[10],
+                        "media_files": []
+                    }
+
+                cursor.execute(f"""
+                    SELECT message_id, media_type, media_path, file_id
+                    FROM media_files
+                    WHERE owner_id = ? AND chat_id = ? AND message_id IN ({placeholders})
+                    ORDER BY id
+                """, (owner_id, chat_id, *chunk))
+
+                for message_id, media_type, media_path, file_id in cursor.fetchall():
+                    if message_id in messages:
+                        messages[message_id]["media_files"].append((media_type, media_path, file_id))
+
+        return messages
+
+    @_offload("read")
+    def get_edit_history(self, owner_id: int, chat_id: int, message_id: int):
+        with self.pool.reader() as conn:
+            return conn.execute("""
+                SELECT old_text, action_date
+                FROM message_actions
+                WHERE owner_id = ? AND chat_id = ? AND message_id = ? AND action_type = 'edit'
+                ORDER BY action_date ASC
+            """, (owner_id, chat_id, message_id)).fetchall()
+
+    async def search_messages(self, owner_id: int, query: str, limit: int = 5, offset: int = 0):
+        await self.flush()
+        return await self._search_messages(owner_id, query, limit, offset)
+
+    @_offload("read")
+    def _search_messages(self, owner_id: int, query: str, limit: int, offset: int):
+        with self.pool.reader() as conn:
+            return conn.execute("""
+                WITH hits AS (
+                    SELECT m.chat_id, m.message_id, 'message' AS source, m.text, m.date, messages_fts.rank AS rank
+                    FROM messages_fts
+                    CROSS JOIN messages m ON m.rowid = messages_fts.rowid
+                    WHERE messages_fts MATCH ? AND m.owner_id = ?
+                    AND NOT EXISTS (
+                        SELECT 1 FROM message_actions
+                        WHERE owner_id = m.owner_id AND chat_id = m.chat_id AND message_id = m.message_id AND action_type = 'delete'
+                    )
+                    UNION ALL
+                    SELECT a.chat_id, a.message_id, a.action_type, a.old_text, a.action_date, message_actions_fts.rank
+                    FROM message_actions_fts
+                    CROSS JOIN message_actions a ON a.id = message_actions_fts.rowid
+                    WHERE message_actions_fts MATCH ? AND a.owner_id = ?
+                ),
+                best AS (
+                    SELECT chat_id, message_id, source, text, date, MIN(rank) AS rank
+                    FROM hits
+                    GROUP BY chat_id, message_id
+                )
+                SELECT b.chat_id, b.message_id, b.source, b.text, b.date, u.username
+                FROM best b
+                JOIN messages m ON m.owner_id = ? AND m.chat_id = b.chat_id AND m.message_id = b.message_id
+                JOIN users u ON u.id = m.user_id
+                ORDER BY b.rank
+                LIMIT ? OFFSET ?
+            """, (
+                _fts_query(query),
+                owner_id,
+                _fts_query(query),
+                owner_id,
+                owner_id,
+                limit,
+                offset
+            )).fetchall()
+
+    @_offload("read")
+    def resolve_user(self, owner_id: int, user: str):
+        with self.pool.reader() as conn:
+            return _resolve_user(conn.cursor(), owner_id, user)
+
+    @_offload("read")
+    def get_username(self, user_id: int):
+        with self.pool.reader() as conn:
+            row = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    @_offload("read")
+    def get_user_actions(self, owner_id: int, username: str, limit: int = 5, before: int = None, after: int = None):
+        if after is not None:
+            cursor_filter, order, cursor_id = "AND (ma.action_date, ma.id) > (SELECT action_date, id FROM message_actions WHERE id = ?)", "ASC", after
+        elif before is not None:
+            cursor_filter, order, cursor_id = "AND (ma.action_date, ma.id) < (SELECT action_date, id FROM message_actions WHERE id = ?)", "DESC", before
+        else:
+            cursor_filter, order, cursor_id = "", "DESC", None
+
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+
+            user_id = _resolve_user(cursor, owner_id, username)
+            if user_id is None:
+                return None, []
+
+            cursor.execute(f"""
+                SELECT
+                    ma.id,
+                    ma.action_type,
+                    ma.old_text,
+                    ma.new_text,
+                    ma.action_date,
+                    m.is_forwarded,
+                    m.forward_from,
+                    m.chat_id,
+                    m.message_id,
+                    m.latitude,
+                    m.longitude
+                FROM message_actions ma
+                JOIN messages m ON ma.owner_id = m.owner_id AND ma.chat_id = m.chat_id AND ma.message_id = m.message_id
+                WHERE ma.owner_id = ? AND ma.user_id = ? {cursor_filter}
+                ORDER BY ma.action_date {order}, ma.id {order}
+                LIMIT ?
+            """, (owner_id, user_id, *([cursor_id] if cursor_id is not None else []), limit))
+            rows = cursor.fetchall()
+
+        if order == "ASC":
+            rows.reverse()
+
         actions = []
-        for row in cursor.fetchall():
-            action_type = row[0]
-            old_text = row[1]
-            new_text = row[2]
-            action_date = row[3]
-            is_forwarded = bool(row[4])
-            forward_from = row[5]
-            chat_id = row[6]
-            message_id = row[7]
-            latitude = row[8]
-            longitude = row[9]
-            
+        for row in rows:
+            action_id = row[0]
+            action_type = row[1]
+            old_text = row[2]
+            new_text = row[3]
+            action_date = row[4]
+            is_forwarded = bool(row[5])
+            forward_from = row[6]
+            chat_id = row[7]
+            message_id = row[8]
+            latitude = row[9]
+            longitude = row[10]
+
             display_text = old_text if action_type == 'delete' else new_text
             action_name = 'deleted' if action_type == 'delete' else 'edited'
-            
-            actions.append((action_name, display_text, action_date, is_forwarded, forward_from, chat_id, message_id, latitude, longitude))
-        
-        conn.close()
+
+            actions.append((action_id, action_name, display_text, action_date, is_forwarded, forward_from, chat_id, message_id, latitude, longitude))
+
         return user_id, actions
 
-    def delete_message(self, chat_id: int, message_id: int):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT text FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
-        row = cursor.fetchone()
-        if row:
-            self.save_message_action(chat_id, message_id, 'delete', row[0])
-        
-        cursor.execute(
-            "SELECT media_path FROM media_files WHERE chat_id = ? AND message_id = ?",
-            (chat_id, message_id)
-        )
-        
-        media_paths = [row[0] for row in cursor.fetchall()]
-        
-        for media_path in media_paths:
-            if media_path and os.path.exists(media_path):
-                os.remove(media_path)
-        
-        conn.commit()
-        conn.close()
+    async def delete_messages(self, owner_id: int, chat_id: int, message_ids):
+        media_paths = await self._delete_messages(owner_id, chat_id, message_ids)
+        await self._remove_files(media_paths)
         return media_paths
 
-    def get_settings(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT key, value FROM settings")
-        settings = dict(cursor.fetchall())
-        
-        conn.close()
-        
-        return {
-            "notify_edited": bool(settings.get("notify_edited", 1)),
-            "notify_deleted": bool(settings.get("notify_deleted", 1)),
-            "ignore_changes_below": int(settings.get("ignore_changes_below", 0))
-        }
+    @_offload("write")
+    def _delete_messages(self, owner_id: int, chat_id: int, message_ids):
+        message_ids = list(message_ids)
+        media_paths = []
+        action_date = datetime.now().isoformat()
+
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+
+            for start in range(0, len(message_ids), SQLITE_CHUNK_SIZE):
+                chunk = message_ids[start:start + SQLITE_CHUNK_SIZE]
+                placeholders = ','.join('?' for _ in chunk)
+
+                cursor.execute(f"""
+                    INSERT INTO message_actions (owner_id, chat_id, message_id, user_id, action_type, old_text, new_text, action_date)
+                    SELECT owner_id, chat_id, message_id, user_id, 'delete', text, NULL, ?
+                    FROM messages
+                    WHERE owner_id = ? AND chat_id = ? AND message_id IN ({placeholders})
+                """, (action_date, owner_id, chat_id, *chunk))
+
+                cursor.execute(f"""
+                    SELECT id, file_unique_id, media_path FROM media_files
+                    WHERE owner_id = ? AND chat_id = ? AND message_id IN ({placeholders}) AND status != 'released'
+                """, (owner_id, chat_id, *chunk))
+                media_paths.extend(self._release_media(cursor, cursor.fetchall()))
+
+        for message_id in message_ids:
+            self.message_cache.pop((owner_id, chat_id, message_id))
+
+        return media_paths
+
+    @_offload("write")
+    def set_media_status(self, media_path: str, status: str, size: int = None):
+        with self.pool.writer() as conn:
+            conn.execute(
+                "UPDATE media_files SET status = ? WHERE media_path = ? AND status != 'released'",
+                (status, media_path)
+            )
+            if size is not None:
+                cursor = conn.execute(
+                    "UPDATE media_store SET size = ? WHERE media_path = ? AND size IS NULL",
+                    (size, media_path)
+                )
+                if cursor.rowcount:
+                    self.media_bytes += size
+            return conn.execute("""
+                SELECT 1 FROM media_store WHERE media_path = ?
+                UNION ALL
+                SELECT 1 FROM media_files WHERE media_path = ? AND file_unique_id IS NULL AND status != 'released'
+                LIMIT 1
+            """, (media_path, media_path)).fetchone() is not None
+
+    @_offload("read")
+    def get_media_paths(self):
+        with self.pool.reader() as conn:
+            return conn.execute("""
+                SELECT media_path, file_unique_id FROM media_store
+                UNION
+                SELECT media_path, NULL FROM media_files WHERE file_unique_id IS NULL AND media_path != ''
+            """).fetchall()
+
+    @_offload("write")
+    def rename_media_path(self, old_path: str, new_path: str):
+        with self.pool.writer() as conn:
+            conn.execute("UPDATE media_store SET media_path = ? WHERE media_path = ?", (new_path, old_path))
+            conn.execute("UPDATE media_files SET media_path = ? WHERE media_path = ?", (new_path, old_path))
+
+        self.message_cache.evict(lambda message: any(media[1] == old_path for media in message["media_files"]))
+
+    @_offload("read")
+    def get_pending_media(self):
+        with self.pool.reader() as conn:
+            return conn.execute(
+                "SELECT media_path, MIN(file_id), MIN(media_type) FROM media_files WHERE status = 'pending' GROUP BY media_path"
+            ).fetchall()
+
+    @_offload("write")
+    def add_notification(self, owner_id: int, kind: str, media_files, text: str):
+        with self.pool.writer() as conn:
+            held_paths = [
+                media_path for media_path in dict.fromkeys(media_path for _, media_path, _ in media_files if media_path)
+                if conn.execute("UPDATE media_store SET ref_count = ref_count + 1 WHERE media_path = ?", (media_path,)).rowcount
+            ]
+            cursor = conn.execute(
+                "INSERT INTO outbox (owner_id, kind, media_files, text, created_at, held_paths) VALUES (?, ?, ?, ?, ?, ?)",
+                (owner_id, kind, json.dumps(media_files), text, datetime.now().isoformat(), json.dumps(held_paths))
+            )
+            return cursor.lastrowid
+
+    async def delete_notification(self, notification_id: int):
+        await self._remove_files(await self._delete_notification(notification_id))
+
+    @_offload("write")
+    def _delete_notification(self, notification_id: int):
+        with self.pool.writer() as conn:
+            row = conn.execute("SELECT held_paths FROM outbox WHERE id = ?", (notification_id,)).fetchone()
+            conn.execute("DELETE FROM outbox WHERE id = ?", (notification_id,))
+            if not row or not row[0]:
+                return []
+
+            unused_paths = []
+            for media_path in json.loads(row[0]):
+                conn.execute("UPDATE media_store SET ref_count = ref_count - 1 WHERE media_path = ?", (media_path,))
+                for size, in conn.execute("SELECT size FROM media_store WHERE media_path = ? AND ref_count <= 0", (media_path,)).fetchall():
+                    unused_paths.append(media_path)
+                    self.media_bytes -= size or 0
+                conn.execute("DELETE FROM media_store WHERE media_path = ? AND ref_count <= 0", (media_path,))
+            return unused_paths
+
+    @_offload("read")
+    def get_notifications(self):
+        with self.pool.reader() as conn:
+            rows = conn.execute("SELECT id, owner_id, kind, media_files, text FROM outbox ORDER BY id").fetchall()
+        return [
+            (notification_id, owner_id, kind, [tuple(media_file) for media_file in json.loads(media_files)], text)
+            for notification_id, owner_id, kind, media_files, text in rows
+        ]
+
+    @_offload("write")
+    def _write_connection(self, connection_id: str, owner_id: int, is_enabled: bool):
+        with self.pool.writer() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO business_connections (id, owner_id, is_enabled) VALUES (?, ?, ?)",
+                (connection_id, owner_id, int(is_enabled))
+            )
+
+    async def save_connection(self, connection_id: str, owner_id: int, is_enabled: bool = True):
+        await self._write_connection(connection_id, owner_id, is_enabled)
+        self.connections[connection_id] = owner_id if is_enabled else None
 
-    def toggle_setting(self, key: str):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("UPDATE settings SET value = 1 - value WHERE key = ?", (key,))
-        
-        conn.commit()
-        conn.close()
-
-    def get_stats(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_messages = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM media_files")
-        total_media = cursor.fetchone()[0]
-        
-        conn.close()
-        
+    @_offload("write")
+    def _write_setting(self, key: str, value: int):
+        with self.pool.writer() as conn:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    @_offload("read")
+    def get_stats(self, owner_id: int):
+        with self.pool.reader() as conn:
+            row = conn.execute("SELECT messages, media FROM owner_stats WHERE owner_id = ?", (owner_id,)).fetchone()
+
+        total_messages, total_media = row or (0, 0)
         return {
             "total_messages": total_messages,
-            "total_media": total_media
+            "total_media": total_media,
+            "media_bytes": self.media_bytes
         }
 
-    def cleanup_old_messages(self, hours=24):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+    @_offload("write")
+    def rebuild_stats(self):
+        with self.pool.writer() as conn:
+            return _rebuild_stats(conn.cursor())
+
+    async def cleanup_old_messages(self, hours=24, batch_size=CLEANUP_BATCH_SIZE):
         cutoff_time = (datetime.now() - timedelta(hours=hours)).isoformat()
-        
-        cursor.execute("SELECT chat_id, message_id FROM messages WHERE date < ?", (cutoff_time,))
-        old_messages = cursor.fetchall()
-        
+
         deleted_count = 0
-        for chat_id, message_id in old_messages:
-            cursor.execute("SELECT media_path FROM media_files WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
-            media_paths = [row[0] for row in cursor.fetchall()]
-            
-            for media_path in media_paths:
-                if media_path and os.path.exists(media_path):
-                    try:
-                        os.remove(media_path)
-                    except:
-                        pass
-            
-            cursor.execute("DELETE FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
-            deleted_count += 1
-        
-        conn.commit()
-        conn.close()
-        
+        while True:
+            count, media_paths = await self._delete_expired_batch(cutoff_time, batch_size)
+            deleted_count += count
+
+            await self._remove_files(media_paths)
+
+            if count < batch_size:
+                break
+
+        self.message_cache.evict(lambda message: message["date"] < cutoff_time)
+
         return deleted_count
 
-    def cleanup_all(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        messages_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT media_path FROM media_files")
-        media_paths = [row[0] for row in cursor.fetchall()]
-        files_count = len(media_paths)
-        
-        for media_path in media_paths:
-            if media_path and os.path.exists(media_path):
-                try:
-                    os.remove(media_path)
-                except:
-                    pass
-                    
-        if os.path.exists("media"):
-            try:
-                os.rmdir("media")
-            except:
-                pass
-        
-        cursor.execute("DELETE FROM message_actions")
-        cursor.execute("DELETE FROM media_files")
-        cursor.execute("DELETE FROM messages")
-        cursor.execute("DELETE FROM users")
-        
-        conn.commit()
-        conn.close()
-        
+    @_offload("write")
+    def _delete_expired_batch(self, cutoff_time: str, batch_size: int):
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS expired_messages (
+                    owner_id INTEGER,
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    PRIMARY KEY (owner_id, chat_id, message_id)
+                )
+            """)
+            cursor.execute("DELETE FROM expired_messages")
+            cursor.execute("""
+                INSERT INTO expired_messages (owner_id, chat_id, message_id)
+                SELECT owner_id, chat_id, message_id FROM messages
+                WHERE date < ?
+                LIMIT ?
+            """, (cutoff_time, batch_size))
+            count = cursor.rowcount
+
+            cursor.execute("""
+                SELECT mf.id, mf.file_unique_id, mf.media_path FROM expired_messages e
+                CROSS JOIN media_files mf ON mf.owner_id = e.owner_id AND mf.chat_id = e.chat_id AND mf.message_id = e.message_id
+                WHERE mf.status != 'released'
+            """)
+            media_paths = self._release_media(cursor, cursor.fetchall(), mark_released=False)
+
+            for table in ("media_files", "message_actions", "messages"):
+                cursor.execute(f"""
+                    DELETE FROM {table}
+                    WHERE (owner_id, chat_id, message_id) IN (SELECT owner_id, chat_id, message_id FROM expired_messages)
+                """)
+
+        return count, media_paths
+
+    async def cleanup_all(self, owner_id: int):
+        self.users.clear()
+        messages_count, files_count, media_paths = await self._cleanup_all(owner_id)
+
+        await self._remove_files(media_paths)
+        await asyncio.get_running_loop().run_in_executor(None, remove_empty_dirs, MEDIA_DIR)
+
         return messages_count, files_count
 
-    def get_user_stats(self, username: str):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                u.id,
-                COUNT(DISTINCT m.message_id) as total_messages,
-                COUNT(DISTINCT ma.id) as total_actions,
-                COUNT(DISTINCT mf.id) as total_media
-            FROM users u
-            LEFT JOIN messages m ON u.id = m.user_id
-            LEFT JOIN message_actions ma ON m.chat_id = ma.chat_id AND m.message_id = ma.message_id
-            LEFT JOIN media_files mf ON m.chat_id = mf.chat_id AND m.message_id = mf.message_id
-            WHERE u.username = ?
-            GROUP BY u.id
-        """, (username,))
-        
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
-            return None
-            
-        user_id = row[0]
-        
-        cursor.execute("""
-            SELECT value FROM settings 
-            WHERE key = ? 
-        """, (f"notify_user_{user_id}",))
-        
-        notify_row = cursor.fetchone()
-        notify_enabled = bool(notify_row[0]) if notify_row else True
-        
-        conn.close()
-        
+    @_offload("write")
+    def _cleanup_all(self, owner_id: int):
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("SELECT messages, media FROM owner_stats WHERE owner_id = ?", (owner_id,))
+            messages_count, files_count = cursor.fetchone() or (0, 0)
+
+            cursor.execute(
+                "SELECT id, file_unique_id, media_path FROM media_files WHERE owner_id = ? AND status != 'released'",
+                (owner_id,)
+            )
+            media_paths = self._release_media(cursor, cursor.fetchall(), mark_released=False)
+
+            for table in ("message_actions", "media_files", "messages"):
+                cursor.execute(f"DELETE FROM {table} WHERE owner_id = ?", (owner_id,))
+            cursor.execute("DELETE FROM users WHERE id NOT IN (SELECT user_id FROM messages)")
+            cursor.execute("DELETE FROM username_history WHERE user_id NOT IN (SELECT id FROM users)")
+
+        self.message_cache.evict(lambda message: message["owner_id"] == owner_id)
+
+        return messages_count, files_count, media_paths
+
+    @_offload("read")
+    def get_user_stats(self, owner_id: int, username: str):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+
+            user_id = _resolve_user(cursor, owner_id, username)
+            if user_id is None:
+                return None
+
+            row = cursor.execute("""
+                SELECT u.username, COALESCE(s.messages, 0), COALESCE(s.actions, 0), COALESCE(s.media, 0)
+                FROM users u
+                LEFT JOIN user_stats s ON s.owner_id = ? AND s.user_id = u.id
+                WHERE u.id = ?
+            """, (owner_id, user_id)).fetchone()
+
         return {
             "user_id": user_id,
+            "username": row[0],
             "total_messages": row[1],
             "total_actions": row[2],
             "total_media": row[3],
-            "notify_enabled": notify_enabled
+            "notify_enabled": self.get_user_notify(owner_id, user_id)
         }
 
-    def toggle_user_notify(self, user_id: int):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        key = f"notify_user_{user_id}"
-        
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        
-        if row is None:
-            cursor.execute("INSERT INTO settings (key, value) VALUES (?, 0)", (key,))
-        else:
-            cursor.execute("UPDATE settings SET value = 1 - value WHERE key = ?", (key,))
-        
-        conn.commit()
-        conn.close()
-
-    def cleanup_user_data(self, username: str):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        user_row = cursor.fetchone()
-        if not user_row:
-            conn.close()
-            return 0, 0
-            
-        user_id = user_row[0]
-        
-        cursor.execute("""
-            SELECT chat_id, message_id FROM messages 
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        messages = cursor.fetchall()
-        deleted_messages = 0
-        deleted_files = 0
-        
-        for chat_id, message_id in messages:
-            cursor.execute(
-                "SELECT media_path FROM media_files WHERE chat_id = ? AND message_id = ?",
-                (chat_id, message_id)
-            )
-            
-            media_paths = [row[0] for row in cursor.fetchall()]
-            
-            for media_path in media_paths:
-                if media_path and os.path.exists(media_path):
-                    try:
-                        os.remove(media_path)
-                        deleted_files += 1
-                    except:
-                        pass
-                        
-            cursor.execute("DELETE FROM media_files WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
-            cursor.execute("DELETE FROM message_actions WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
-            cursor.execute("DELETE FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
-            deleted_messages += 1
-        
-        conn.commit()
-        conn.close()
-        
+    async def cleanup_user_data(self, owner_id: int, username: str):
+        deleted_messages, media_paths = await self._cleanup_user_data(owner_id, username)
+        deleted_files = await self._remove_files(media_paths)
         return deleted_messages, deleted_files
 
-    def get_message_history(self, message_id: int):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                COALESCE(
-                    (SELECT old_text 
-                     FROM message_actions 
-                     WHERE chat_id = m.chat_id 
-                     AND message_id = m.message_id 
-                     AND action_type = 'edit'
-                     ORDER BY action_date ASC
-                     LIMIT 1),
-                    m.text
-                ) as original_text,
-                m.chat_id,
-                m.date,
-                m.is_forwarded,
-                m.forward_from,
-                u.username,
-                m.text as current_text,
-                m.latitude,
-                m.longitude
-            FROM messages m
-            JOIN users u ON m.user_id = u.id
-            WHERE m.message_id = ?
-        """, (message_id,))
-        message_info = cursor.fetchone()
-        
-        if not message_info:
-            conn.close()
-            return None
-            
-        original_text, chat_id, date, is_forwarded, forward_from, username, current_text, latitude, longitude = message_info
-        
-        cursor.execute("""
-            SELECT action_type, old_text, new_text, action_date
-            FROM message_actions
-            WHERE message_id = ? AND chat_id = ?
-            ORDER BY action_date ASC
-        """, (message_id, chat_id))
-        actions = cursor.fetchall()
-        
-        cursor.execute("""
-            SELECT media_type, media_path, file_id
-            FROM media_files
-            WHERE chat_id = ? AND message_id = ?
-        """, (chat_id, message_id))
-        media_files = cursor.fetchall()
-        
-        conn.close()
-        
+    @_offload("write")
+    def _cleanup_user_data(self, owner_id: int, username: str):
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+
+            user_id = _resolve_user(cursor, owner_id, username)
+            if user_id is None:
+                return 0, []
+
+            cursor.execute("""
+                SELECT mf.id, mf.file_unique_id, mf.media_path FROM media_files mf
+                JOIN messages m ON mf.owner_id = m.owner_id AND mf.chat_id = m.chat_id AND mf.message_id = m.message_id
+                WHERE m.owner_id = ? AND m.user_id = ? AND mf.status != 'released'
+            """, (owner_id, user_id))
+            media_paths = self._release_media(cursor, cursor.fetchall(), mark_released=False)
+
+            for table in ("media_files", "message_actions"):
+                cursor.execute(f"""
+                    DELETE FROM {table}
+                    WHERE (owner_id, chat_id, message_id) IN (
+                        SELECT owner_id, chat_id, message_id FROM messages WHERE owner_id = ? AND user_id = ?
+                    )
+                """, (owner_id, user_id))
+            cursor.execute("DELETE FROM messages WHERE owner_id = ? AND user_id = ?", (owner_id, user_id))
+            deleted_messages = cursor.rowcount
+
+        self.message_cache.evict(lambda message: message["owner_id"] == owner_id and message["user_id"] == user_id)
+
+        return deleted_messages, media_paths
+
+    @_offload("read")
+    def get_message_history(self, owner_id: int, message_id: int):
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                SELECT
+                    COALESCE(
+                        (SELECT old_text
+                         FROM message_actions
+                         WHERE owner_id = m.owner_id
+                         AND chat_id = m.chat_id
+                         AND message_id = m.message_id
+                         AND action_type = 'edit'
+                         ORDER BY action_date ASC
+                         LIMIT 1),
+                        m.text
+                    ) as original_text,
+                    m.chat_id,
+                    m.date,
+                    m.is_forwarded,
+                    m.forward_from,
+                    u.username,
+                    m.text as current_text,
+                    m.latitude,
+                    m.longitude
+                FROM messages m
+                JOIN users u ON m.user_id = u.id
+                WHERE m.owner_id = ? AND m.message_id = ?
+            """, (owner_id, message_id))
+            message_info = cursor.fetchone()
+
+            if not message_info:
+                return None
+
+            original_text, chat_id, date, is_forwarded, forward_from, username, current_text, latitude, longitude = message_info
+
+            cursor.execute("""
+                SELECT action_type, old_text, new_text, action_date
+                FROM message_actions
+                WHERE owner_id = ? AND chat_id = ? AND message_id = ?
+                ORDER BY action_date ASC
+            """, (owner_id, chat_id, message_id))
+            actions = cursor.fetchall()
+
+            cursor.execute("""
+                SELECT media_type, media_path, file_id
+                FROM media_files
+                WHERE owner_id = ? AND chat_id = ? AND message_id = ?
+            """, (owner_id, chat_id, message_id))
+            media_files = cursor.fetchall()
+
         return {
             'original_text': original_text,
             'chat_id': chat_id,
@@ -613,12 +1330,3 @@ class Database:
             'latitude': latitude,
             'longitude': longitude
         }
-
-    def set_ignore_changes_below(self, amount: int):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('ignore_changes_below', ?)", (amount,))
-        
-        conn.commit()
-        conn.close()
\ No newline at end of file
@@ -1,15 +1,23 @@
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiohttp import web
 from dotenv import load_dotenv
 import os
 import asyncio
+import hashlib
 from datetime import datetime
-import sqlite3
 
-from database import Database
+from storage import create_storage
+from media import MEDIA_TYPES, MEGABYTE, MediaDownloader
+from notifier import Notifier
+from webhook import ConcurrencyLimit, build_app
 from utils import (
+    MESSAGE_LIMIT,
     escape_markdown,
     format_as_quote,
+    format_diff_quotes,
+    shorten_quote,
+    edit_distance,
     save_message,
     collect_media_from_message,
     send_media_message
@@ -20,21 +28,110 @@ load_dotenv()
 bot = Bot(token=os.getenv("TOKEN"))
 dp = Dispatcher()
 
-db = Database()
-
 MESSAGES_LIFETIME = int(os.getenv("MESSAGES_LIFETIME", 24))
 CLEANUP_INTERVAL = int(os.getenv("CLEANUP_INTERVAL", 3600))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 4))
+MAX_MEDIA_SIZE = int(os.getenv("MAX_MEDIA_SIZE_MB", 20)) * MEGABYTE
+MEDIA_SIZE_LIMITS = {
+    media_type: int(os.getenv(f"MAX_{media_type.upper()}_SIZE_MB", 0)) * MEGABYTE or MAX_MEDIA_SIZE
+    for media_type in MEDIA_TYPES
+}
+MEDIA_DISK_QUOTA = int(os.getenv("MEDIA_DISK_QUOTA_MB", 0)) * MEGABYTE
+LAZY_MEDIA = os.getenv("MEDIA_MODE", "eager") == "lazy"
+MEDIA_PREFETCH_TYPES = [media_type for media_type in os.getenv("MEDIA_PREFETCH", "video_note,voice").split(",") if media_type]
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", 1))
+NOTIFY_BURST = int(os.getenv("NOTIFY_BURST", 20))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", 30))
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", 30))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 0))
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+SEARCH_PAGE_SIZE = 5
+SEARCH_QUERY_LIMIT = 200
+HISTORY_PAGE_LIMIT = 20
+SEARCH_HEADER = "🔍 Search: "
+CALLBACK_DATA_LIMIT = 64
+SEARCH_TOKENS_LIMIT = 1024
+
+OWNER_IDS = {int(owner) for owner in os.getenv("USER_ID", "").split(",") if owner.strip()}
+
+ALLOWED_UPDATES = [
+    "message",
+    "business_message",
+    "edited_business_message",
+    "deleted_business_messages",
+    "business_connection",
+    "callback_query"
+]
+
+db = create_storage(DATABASE_URL, lazy_media=LAZY_MEDIA, prefetch_types=MEDIA_PREFETCH_TYPES)
+
+downloader = MediaDownloader(
+    bot,
+    db,
+    workers=DOWNLOAD_WORKERS,
+    size_limits=MEDIA_SIZE_LIMITS,
+    disk_quota=MEDIA_DISK_QUOTA
+)
+
+notifier = Notifier(bot, db, rate=NOTIFY_RATE, burst=NOTIFY_BURST, digest_window=DIGEST_WINDOW, global_rate=NOTIFY_GLOBAL_RATE)
+
+limiter = ConcurrencyLimit(UPDATE_CONCURRENCY)
+
+search_queries = {}
+dp.update.outer_middleware(limiter)
+
+def is_allowed_owner(user_id: int):
+    return not OWNER_IDS or user_id in OWNER_IDS
+
+async def resolve_owner(connection_id: str):
+    if not connection_id:
+        return None
+
+    if not db.has_connection(connection_id):
+        try:
+            connection = await bot.get_business_connection(business_connection_id=connection_id)
+        except Exception as e:
+            print(f"{datetime.now()}: Failed to resolve business connection {connection_id}: {e}")
+            return None
+
+        await db.save_connection(connection_id, connection.user.id, connection.is_enabled)
+
+    owner_id = db.get_connection_owner(connection_id)
+    if owner_id is None:
+        return None
+    return owner_id if is_allowed_owner(owner_id) else None
 
-def get_status_message():
-    settings = db.get_settings()
-    stats = db.get_stats()
+async def get_status_message(owner_id: int):
+    settings = db.get_settings(owner_id)
+    stats = await db.get_stats(owner_id)
+    cache = db.cache_stats()
+    notifications = notifier.stats()
     
     ignore_status = "no limit" if settings["ignore_changes_below"] == 0 else f"*{settings['ignore_changes_below']}* chars"
+    notify_status = escape_markdown(
+        f"{notifications['queued']} queued for {notifications['chats']} chats, {notifications['digests']} digests pending, {notifications['sent']} sent, {notifications['failed']} failed, "
+        f"{notifications['avg_latency']:.1f}s avg delivery, {notifications['avg_send_time']:.2f}s avg send"
+    )
+    disk_status = f"{stats['media_bytes'] / MEGABYTE:.1f} MB"
+    if MEDIA_DISK_QUOTA:
+        disk_status += f" of {MEDIA_DISK_QUOTA / MEGABYTE:.0f} MB"
     
     status_text = (
         "*Bot Status:*\n\n"
         f"Messages saved: *{stats['total_messages']}*\n"
         f"Media files saved: *{stats['total_media']}*\n"
+        f"Media disk usage: *{escape_markdown(disk_status)}*\n"
+    )
+    if cache:
+        cache_status = escape_markdown(f"{cache['hit_rate']:.0%} hits, {cache['entries']} messages, {cache['bytes'] / 1024 / 1024:.1f} MB")
+        status_text += f"Message cache: {cache_status}\n"
+    status_text += (
+        f"Notifications: {notify_status}\n"
         f"Ignore edits below: {ignore_status}\n\n"
         "*Settings:*"
     )
@@ -48,13 +145,129 @@ def get_status_message():
         text=f"Deleted: {'ON' if settings['notify_deleted'] else 'OFF'}", 
         callback_data="toggle_deleted"
     )
+    builder.button(
+        text=f"Digest ({DIGEST_WINDOW}s): {'ON' if settings['digest_mode'] else 'OFF'}", 
+        callback_data="toggle_digest"
+    )
     builder.adjust(1)
     
     return status_text, builder.as_markup()
 
+async def get_history_message(owner_id: int, username: str, limit: int, before: int = None, after: int = None):
+    user_id, actions = await db.get_user_actions(owner_id, username, limit + 1, before, after)
+    if not actions:
+        return None, None
+
+    if username.isdigit():
+        username = await db.get_username(user_id) or username
+
+    if after is None:
+        has_older = len(actions) > limit
+        has_newer = before is not None
+        actions = actions[:limit]
+    else:
+        has_older = True
+        has_newer = len(actions) > limit
+        actions = actions[-limit:]
+
+    header = f"📋 Actions by @{escape_markdown(username)} \\(ID: `{user_id}`\\):\n\n"
+
+    entries = []
+    for action_id, action_name, msg_text, date, is_forwarded, forward_from, chat_id, message_id, latitude, longitude in actions:
+        dt = datetime.fromisoformat(date)
+        time = dt.strftime("%H:%M:%S")
+
+        if action_name == 'deleted':
+            icon = "🗑"
+        else:
+            icon = "✏️"
+
+        if is_forwarded and forward_from:
+            entry = f"{icon} _{escape_markdown(time)}_ /{message_id} \\(_{escape_markdown(f'from @{forward_from}')}_)\n"
+        else:
+            entry = f"{icon} _{escape_markdown(time)}_ /{message_id}\n"
+
+        if latitude is not None and longitude is not None:
+            maps_url = f"https://www.google.com/maps?q={latitude},{longitude}"
+            entry += f"{format_as_quote(msg_text)} [Where?]({maps_url})\n\n"
+        else:
+            entry += f"{format_as_quote(msg_text)}\n\n"
+
+        entries.append((action_id, entry))
+
+    if after is not None:
+        entries.reverse()
+
+    page = []
+    size = len(header)
+    for action_id, entry in entries:
+        if page and size + len(entry) > MESSAGE_LIMIT:
+            if after is None:
+                has_older = True
+            else:
+                has_newer = True
+            break
+        page.append((action_id, entry))
+        size += len(entry)
+
+    if after is not None:
+        page.reverse()
+
+    builder = InlineKeyboardBuilder()
+    if has_newer:
+        builder.button(text="⬅️ Newer", callback_data=f"actions_{user_id}_{limit}_n_{page[0][0]}")
+    if has_older:
+        builder.button(text="Older ➡️", callback_data=f"actions_{user_id}_{limit}_o_{page[-1][0]}")
+    builder.adjust(2)
+
+    return header + "".join(entry for _, entry in page), builder.as_markup()
+
+def search_callback(query: str, page: int) -> str:
+    callback_data = f"search_{page}_q{query}"
+    if len(callback_data.encode()) <= CALLBACK_DATA_LIMIT:
+        return callback_data
+
+    token = hashlib.sha1(query.encode()).hexdigest()[:16]
+    search_queries.pop(token, None)
+    search_queries[token] = query
+    while len(search_queries) > SEARCH_TOKENS_LIMIT:
+        del search_queries[next(iter(search_queries))]
+    return f"search_{page}_t{token}"
+
+async def get_search_message(owner_id: int, query: str, page: int = 0):
+    results = await db.search_messages(owner_id, query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    if not results:
+        return None, None
+
+    text = f"{escape_markdown(SEARCH_HEADER + query)}\n_page {page + 1}_\n\n"
+    budget = (MESSAGE_LIMIT - len(text)) // SEARCH_PAGE_SIZE
+    for chat_id, message_id, source, msg_text, date, username in results[:SEARCH_PAGE_SIZE]:
+        dt = datetime.fromisoformat(date)
+        time = dt.strftime("%H:%M:%S")
+
+        if source == 'delete':
+            icon = "🗑"
+        elif source == 'edit':
+            icon = "✏️"
+        else:
+            icon = "💬"
+
+        entry = f"{icon} _{escape_markdown(time)}_ /{message_id} @{escape_markdown(username or '')}\n"
+        text += f"{entry}{shorten_quote(msg_text, budget - len(entry) - 2)}\n\n"
+
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="⬅️", callback_data=search_callback(query, page - 1))
+    if len(results) > SEARCH_PAGE_SIZE:
+        builder.button(text="➡️", callback_data=search_callback(query, page + 1))
+    builder.adjust(2)
+
+    return text, builder.as_markup()
+
 @dp.message()
 async def start_command(message: types.Message):
-    if str(message.from_user.id) != os.getenv("USER_ID"):
+    owner_id = message.from_user.id
+    if not is_allowed_owner(owner_id):
         return
         
     if not message.from_user.is_premium:
@@ -64,7 +277,7 @@ async def start_command(message: types.Message):
     if message.text and message.text.startswith("/") and message.text[1:].isdigit():
         message_id = int(message.text[1:])
         
-        history = db.get_message_history(message_id)
+        history = await db.get_message_history(owner_id, message_id)
         
         if not history:
             await message.answer(f"Message /{message_id} not found", parse_mode="MarkdownV2")
@@ -94,7 +307,7 @@ async def start_command(message: types.Message):
             elif action_type == 'delete':
                 text += f"🗑 _{formatted_time}_\n{format_as_quote(old_text)}\n\n"
         
-        await send_media_message(bot, history['media_files'], text)
+        await send_media_message(bot, owner_id, history['media_files'], text)
         return
         
     if message.text == "/start":
@@ -115,6 +328,7 @@ async def start_command(message: types.Message):
             "/bot \\- show bot statistics\n"
             "/user \\[username\\] or /u \\- show user statistics\n"
             "/history \\[username\\] \\[limit\\] or /h \\- show user action history\n"
+            "/search \\[text\\] or /s \\- search saved messages, edits and deletions\n"
             "/cleanup or /c \\- clear data\n"
             "/ignore \\[amount\\] \\- ignore edits with less than N changed characters\n\n"
         )
@@ -125,7 +339,7 @@ async def start_command(message: types.Message):
             parse_mode="MarkdownV2"
         )
     elif message.text == "/cleanup all" or message.text == "/c all":
-        deleted_messages, deleted_files = db.cleanup_all()
+        deleted_messages, deleted_files = await db.cleanup_all(owner_id)
         await message.answer(
             f"🗑 *Database completely cleared*\n\n"
             f"Messages deleted: *{deleted_messages}*\n"
@@ -136,7 +350,7 @@ async def start_command(message: types.Message):
         username = message.text.split()[1].lstrip("@")
         
         if username == "all":
-            deleted_messages, deleted_files = db.cleanup_all()
+            deleted_messages, deleted_files = await db.cleanup_all(owner_id)
             await message.answer(
                 f"🗑 *Database completely cleared*\n\n"
                 f"Messages deleted: *{deleted_messages}*\n"
@@ -145,7 +359,7 @@ async def start_command(message: types.Message):
             )
             return
             
-        deleted_messages, deleted_files = db.cleanup_user_data(username)
+        deleted_messages, deleted_files = await db.cleanup_user_data(owner_id, username)
         
         if deleted_messages == 0:
             await message.answer(f"User @{escape_markdown(username)} not found", parse_mode="MarkdownV2")
@@ -157,6 +371,17 @@ async def start_command(message: types.Message):
             f"Files deleted: *{deleted_files}*",
             parse_mode="MarkdownV2"
         )
+    elif message.text == "/search" or message.text == "/s":
+        await message.answer("Usage: `/search text` or `/s text`", parse_mode="MarkdownV2")
+    elif message.text.startswith("/search ") or message.text.startswith("/s "):
+        query = message.text.split(maxsplit=1)[1].strip()[:SEARCH_QUERY_LIMIT]
+        text, reply_markup = await get_search_message(owner_id, query)
+
+        if not text:
+            await message.answer(f"Nothing found for {escape_markdown(query)}", parse_mode="MarkdownV2")
+            return
+
+        await message.answer(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
     elif message.text.startswith("/history") or message.text.startswith("/h"):
         parts = message.text.split()
         if len(parts) < 2:
@@ -174,40 +399,15 @@ async def start_command(message: types.Message):
                 await message.answer("Limit must be a positive number", parse_mode="MarkdownV2")
                 return
 
-        user_id, actions = db.get_user_actions(username, limit)
-        
-        if not actions:
+        text, reply_markup = await get_history_message(owner_id, username, min(limit, HISTORY_PAGE_LIMIT))
+
+        if not text:
             await message.answer(f"No actions found for @{escape_markdown(username)}", parse_mode="MarkdownV2")
             return
-            
-        if user_id:
-            text = f"📋 Actions by @{escape_markdown(username)} \\(ID: `{user_id}`\\):\n\n"
-        else:
-            text = f"📋 Actions by @{escape_markdown(username)}:\n\n"
-        
-        for action_name, msg_text, date, is_forwarded, forward_from, chat_id, message_id, latitude, longitude in actions:
-            dt = datetime.fromisoformat(date)
-            time = dt.strftime("%H:%M:%S")
-            
-            if action_name == 'deleted':
-                icon = "🗑"
-            else:
-                icon = "✏️"
-            
-            if is_forwarded and forward_from:
-                text += f"{icon} _{escape_markdown(time)}_ /{message_id} \\(_{escape_markdown(f'from @{forward_from}')}_)\n"
-            else:
-                text += f"{icon} _{escape_markdown(time)}_ /{message_id}\n"
-            
-            if latitude is not None and longitude is not None:
-                maps_url = f"https://www.google.com/maps?q={latitude},{longitude}"
-                text += f"{format_as_quote(msg_text)} [Where?]({maps_url})\n\n"
-            else:
-                text += f"{format_as_quote(msg_text)}\n\n"
-        
-        await message.answer(text, parse_mode="MarkdownV2")
+
+        await message.answer(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
     elif message.text == "/bot":
-        status_text, reply_markup = get_status_message()
+        status_text, reply_markup = await get_status_message(owner_id)
         
         await message.answer(
             status_text, 
@@ -221,11 +421,13 @@ async def start_command(message: types.Message):
         )
     elif message.text.startswith("/user ") or message.text.startswith("/u "):
         username = message.text.split()[1].lstrip("@")
-        stats = db.get_user_stats(username)
+        stats = await db.get_user_stats(owner_id, username)
         
         if not stats:
             await message.answer(f"User @{escape_markdown(username)} not found", parse_mode="MarkdownV2")
             return
+
+        username = stats['username'] or username
             
         text = (
             f"📊 *Stats for @{escape_markdown(username)}*\n\n"
@@ -247,7 +449,7 @@ async def start_command(message: types.Message):
             reply_markup=builder.as_markup()
         )
     elif message.text == "/ignore":
-        settings = db.get_settings()
+        settings = db.get_settings(owner_id)
         current = settings["ignore_changes_below"]
         status = "no limit" if current == 0 else f"*{current}* characters"
         
@@ -264,7 +466,7 @@ async def start_command(message: types.Message):
             amount = int(message.text.split()[1])
             if amount < 0:
                 raise ValueError
-            db.set_ignore_changes_below(amount)
+            await db.set_ignore_changes_below(owner_id, amount)
             await message.answer(
                 f"Now ignoring edits with less than *{amount}* changed characters",
                 parse_mode="MarkdownV2"
@@ -282,27 +484,27 @@ async def start_command(message: types.Message):
 
 @dp.callback_query()
 async def handle_callback(callback: types.CallbackQuery):
-    if str(callback.from_user.id) != os.getenv("USER_ID"):
+    owner_id = callback.from_user.id
+    if not is_allowed_owner(owner_id):
         return
     
     action = callback.data
     if action == "toggle_edited":
-        db.toggle_setting("notify_edited")
+        await db.toggle_setting(owner_id, "notify_edited")
     elif action == "toggle_deleted":
-        db.toggle_setting("notify_deleted")
+        await db.toggle_setting(owner_id, "notify_deleted")
+    elif action == "toggle_digest":
+        await db.toggle_setting(owner_id, "digest_mode")
     elif action.startswith("toggle_notify_"):
         user_id = int(action.split("_")[2])
-        db.toggle_user_notify(user_id)
+        await db.toggle_user_notify(owner_id, user_id)
         
-        cursor = sqlite3.connect(db.db_path).cursor()
-        cursor.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-        username = cursor.fetchone()[0]
-        cursor.close()
-        
-        stats = db.get_user_stats(username)
+        stats = await db.get_user_stats(owner_id, str(user_id))
         if not stats:
             await callback.answer("User not found")
             return
+
+        username = stats['username'] or str(user_id)
             
         text = (
             f"📊 *Stats for @{escape_markdown(username)}*\n\n"
@@ -325,10 +527,49 @@ async def handle_callback(callback: types.CallbackQuery):
         )
         await callback.answer()
         return
+    elif action.startswith("actions_"):
+        _, user_id, limit, direction, action_id = action.split("_")
+
+        if direction == "o":
+            text, reply_markup = await get_history_message(owner_id, user_id, int(limit), before=int(action_id))
+        else:
+            text, reply_markup = await get_history_message(owner_id, user_id, int(limit), after=int(action_id))
+
+        if not text:
+            await callback.answer("No more actions")
+            return
+
+        await callback.message.edit_text(
+            text,
+            parse_mode="MarkdownV2",
+            reply_markup=reply_markup
+        )
+        await callback.answer()
+        return
+    elif action.startswith("search_"):
+        _, page, key = action.split("_", 2)
+        page = int(page)
+        query = key[1:] if key[0] == "q" else search_queries.get(key[1:])
+        if query is None:
+            await callback.answer("Search expired, run /search again")
+            return
+
+        text, reply_markup = await get_search_message(owner_id, query, page)
+        if not text:
+            await callback.answer("Nothing found")
+            return
+
+        await callback.message.edit_text(
+            text,
+            parse_mode="MarkdownV2",
+            reply_markup=reply_markup
+        )
+        await callback.answer()
+        return
     elif action.startswith("history_"):
         _, chat_id, message_id = action.split("_")
         
-        current_message = db.get_message(int(chat_id), int(message_id))
+        current_message = await db.get_message(owner_id, int(chat_id), int(message_id))
         if not current_message:
             await callback.answer("Message not found")
             return
@@ -337,15 +578,7 @@ async def handle_callback(callback: types.CallbackQuery):
             await callback.answer("История изменений недоступна для медиасообщений")
             return
             
-        cursor = sqlite3.connect(db.db_path).cursor()
-        cursor.execute("""
-            SELECT old_text, new_text, action_date
-            FROM message_actions
-            WHERE chat_id = ? AND message_id = ? AND action_type = 'edit'
-            ORDER BY action_date ASC
-        """, (chat_id, message_id))
-        history = cursor.fetchall()
-        cursor.close()
+        history = await db.get_edit_history(owner_id, int(chat_id), int(message_id))
         
         msg_id = f"/{message_id}"
             
@@ -367,7 +600,7 @@ async def handle_callback(callback: types.CallbackQuery):
         await callback.answer()
         return
     
-    status_text, reply_markup = get_status_message()
+    status_text, reply_markup = await get_status_message(owner_id)
     
     await callback.message.edit_text(
         status_text,
@@ -378,86 +611,113 @@ async def handle_callback(callback: types.CallbackQuery):
 
 @dp.business_message()
 async def message(message: types.Message):
-    if str(message.from_user.id) != os.getenv("USER_ID"):
-        await save_message(bot, message, db)
+    owner_id = await resolve_owner(message.business_connection_id)
+    if owner_id and message.from_user.id != owner_id:
+        await save_message(bot, owner_id, message, db, downloader)
 
 @dp.edited_business_message()
 async def edited_message(message: types.Message):
-    if str(message.from_user.id) == os.getenv("USER_ID"):
+    owner_id = await resolve_owner(message.business_connection_id)
+    if not owner_id or message.from_user.id == owner_id:
         return
 
-    settings = db.get_settings()
+    settings = db.get_settings(owner_id)
     if not settings["notify_edited"]:
         return
 
-    old_message = db.get_message(message.chat.id, message.message_id)
+    old_message = await db.get_message(owner_id, message.chat.id, message.message_id)
         
     if not old_message:
         return
 
-    cursor = sqlite3.connect(db.db_path).cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = ?", (f"notify_user_{old_message['user_id']}",))
-    row = cursor.fetchone()
-    notify_enabled = bool(row[0]) if row else True
-    cursor.close()
-
-    if not notify_enabled:
+    if not db.get_user_notify(owner_id, old_message['user_id']):
         return
 
     new_text = message.md_text or message.caption or ""
     
     if settings["ignore_changes_below"] > 0:
-        old_text = old_message['text']
-        min_len = min(len(old_text), len(new_text))
-        max_len = max(len(old_text), len(new_text))
-
-        changes = sum(1 for i in range(min_len) if old_text[i] != new_text[i])
-        changes += max_len - min_len
-        
+        changes = edit_distance(old_message['text'], new_text, settings["ignore_changes_below"])
         if changes < settings["ignore_changes_below"]:
             return
     
-    db.save_message_action(message.chat.id, message.message_id, 'edit', old_message['text'], new_text)
+    await db.save_message_action(owner_id, message.chat.id, message.message_id, 'edit', old_message['text'], new_text)
     
     media_files = old_message['media_files']
     
     msg_id = f"/{message.message_id}"
     
+    if settings["digest_mode"] and not media_files:
+        notifier.add_digest(
+            owner_id,
+            (message.chat.id, old_message['user_id']),
+            f"🧾 Activity of @{escape_markdown(old_message['username'])}:\n\n",
+            ('edit', message.message_id),
+            f"✏️ {msg_id}",
+            old_message['text'],
+            new_text
+        )
+        await save_message(bot, owner_id, message, db, downloader)
+        return
+    
+    old_quote, new_quote = format_diff_quotes(old_message['text'], new_text)
     text = (
         f"✏️ @{old_message['username']} edited message:\n"
-        f"\n{format_as_quote(old_message['text'])}\n↓"
-        f"\n{format_as_quote(new_text)}\n\n"
+        f"\n{old_quote}\n↓"
+        f"\n{new_quote}\n\n"
         f"{msg_id}"
     )
     
-    await send_media_message(bot, media_files, text)
+    await notifier.send(owner_id, media_files, text)
     
-    await save_message(bot, message, db)
+    await save_message(bot, owner_id, message, db, downloader)
 
 @dp.deleted_business_messages()
 async def deleted_message(business_messages: types.BusinessMessagesDeleted):
-    settings = db.get_settings()
+    owner_id = await resolve_owner(business_messages.business_connection_id)
+    if not owner_id:
+        return
+
+    settings = db.get_settings(owner_id)
     if not settings["notify_deleted"]:
         return
 
+    chat_id = business_messages.chat.id
+    old_messages = await db.get_messages(owner_id, chat_id, business_messages.message_ids)
+    albums = {}
+
     for message_id in business_messages.message_ids:
-        old_message = db.get_message(business_messages.chat.id, message_id)
+        old_message = old_messages.get(message_id)
         
-        if not old_message or str(old_message['user_id']) == os.getenv("USER_ID"):
+        if not old_message or old_message['user_id'] == owner_id:
+            continue
+
+        if not db.get_user_notify(owner_id, old_message['user_id']):
             continue
 
-        cursor = sqlite3.connect(db.db_path).cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (f"notify_user_{old_message['user_id']}",))
-        row = cursor.fetchone()
-        notify_enabled = bool(row[0]) if row else True
-        cursor.close()
+        album_key = old_message['media_group_id'] or message_id
+        albums.setdefault(album_key, []).append(old_message)
 
-        if not notify_enabled:
+    deleted_ids = []
+    for album in albums.values():
+        album.sort(key=lambda old_message: old_message['message_id'])
+        old_message = album[0]
+
+        if settings["digest_mode"] and len(album) == 1 and not old_message['media_files']:
+            notifier.add_digest(
+                owner_id,
+                (chat_id, old_message['user_id']),
+                f"🧾 Activity of @{escape_markdown(old_message['username'])}:\n\n",
+                ('delete', old_message['message_id']),
+                f"🗑 /{old_message['message_id']}",
+                old_message['text']
+            )
+            deleted_ids.append(old_message['message_id'])
             continue
-            
-        msg_id = f"/{message_id}"
 
-        text = f"🗑 @{escape_markdown(old_message['username'])} deleted message:\n\n"
+        if len(album) > 1:
+            text = f"🗑 @{escape_markdown(old_message['username'])} deleted album:\n\n"
+        else:
+            text = f"🗑 @{escape_markdown(old_message['username'])} deleted message:\n\n"
         
         if old_message['is_forwarded'] and old_message['forward_from']:
             text += f"_Forwarded from @{escape_markdown(old_message['forward_from'])}_\n\n"
@@ -465,20 +725,32 @@ async def deleted_message(business_messages: types.BusinessMessagesDeleted):
         if old_message['latitude'] is not None and old_message['longitude'] is not None:
             maps_url = f"https://www.google.com/maps?q={old_message['latitude']},{old_message['longitude']}"
             text += f"📍 Location: `{old_message['latitude']}, {old_message['longitude']}`\n[Where?]({maps_url})\n\n"
+        elif len(album) > 1:
+            for album_message in album:
+                if album_message['text'].strip():
+                    text += f"{format_as_quote(album_message['text'])}\n\n"
         else:
             text += f"{format_as_quote(old_message['text'])}\n\n"
             
-        text += msg_id
+        text += " ".join(f"/{album_message['message_id']}" for album_message in album)
         
-        await send_media_message(bot, old_message['media_files'], text)
+        if len(album) > 1:
+            await notifier.send_album(owner_id, [media_file for album_message in album for media_file in album_message['media_files']], text)
+        else:
+            await notifier.send(owner_id, old_message['media_files'], text)
             
-        db.delete_message(business_messages.chat.id, message_id)
+        deleted_ids.extend(album_message['message_id'] for album_message in album)
+
+    if deleted_ids:
+        await db.delete_messages(owner_id, chat_id, deleted_ids)
 
 @dp.business_connection()
 async def on_business_connection(event: types.BusinessConnection):
-    if str(event.user.id) != os.getenv("USER_ID"):
+    if not is_allowed_owner(event.user.id):
         return
 
+    await db.save_connection(event.id, event.user.id, event.is_enabled)
+
     if event.is_enabled:
         text_="_Bot successfully disconnected from Telegram Business._"
     else:
@@ -492,25 +764,41 @@ async def on_business_connection(event: types.BusinessConnection):
 
 async def cleanup_messages():
     while True:
-        deleted_count = db.cleanup_old_messages(hours=MESSAGES_LIFETIME)
+        deleted_count = await db.cleanup_old_messages(hours=MESSAGES_LIFETIME)
         print(f"{datetime.now()}: Deleted {deleted_count} outdated messages")
         await asyncio.sleep(CLEANUP_INTERVAL)
 
-async def main():
+@dp.startup()
+async def on_startup():
+    await db.connect()
     asyncio.create_task(cleanup_messages())
-    
-    await dp.start_polling(
-        bot,
-        allowed_updates=[
-            "message",
-            "business_message",
-            "edited_business_message",
-            "deleted_business_messages",
-            "business_connection",
-            "callback_query"
-        ],
-    )
+    await downloader.start()
+    await notifier.start()
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+
+@dp.shutdown()
+async def on_shutdown():
+    await notifier.stop()
+    await downloader.stop()
+    await db.close()
+
+async def main():
+    await bot.delete_webhook()
+    await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     print("Starting bot...")
-    asyncio.run(main())
\ No newline at end of file
+    if WEBHOOK_URL:
+        web.run_app(
+            build_app(dp, bot, limiter, WEBHOOK_PATH, WEBHOOK_SECRET),
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT
+        )
+    else:
+        asyncio.run(main())
\ No newline at end of file
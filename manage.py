@@ -0,0 +1,36 @@
+import argparse
+import asyncio
+import os
+from dotenv import load_dotenv
+
+from storage import create_storage
+from media import migrate_media_layout
+
+async def migrate_media(db):
+    moved = await migrate_media_layout(db)
+    print(f"Moved {moved} media files to the sharded layout")
+
+async def rebuild_stats(db):
+    drift = await db.rebuild_stats()
+    print(f"Rebuilt statistics counters, {drift} were out of date")
+
+COMMANDS = {
+    "migrate-media": migrate_media,
+    "rebuild-stats": rebuild_stats,
+}
+
+async def main():
+    parser = argparse.ArgumentParser(description="Telegram Spy Bot maintenance commands")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = create_storage(os.getenv("DATABASE_URL", ""))
+    await db.connect()
+    try:
+        await COMMANDS[args.command](db)
+    finally:
+        await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+import asyncio
+import itertools
+import os
+from datetime import datetime
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from storage import remove_files
+from utils import MediaTooLarge, download_media, media_path_for
+
+UNKNOWN_SIZE_PRIORITY = 2 ** 40
+MEGABYTE = 1024 * 1024
+
+MAX_MEDIA_SIZE = 20 * MEGABYTE
+MEDIA_TYPES = ("photo", "video", "video_note", "voice", "audio", "animation", "document", "sticker")
+
+class MediaDownloader:
+    def __init__(self, bot: Bot, db, workers: int = 4, retries: int = 3, backoff: float = 1.0,
+                 size_limits: dict = None, disk_quota: int = 0):
+        self.bot = bot
+        self.db = db
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.size_limits = size_limits or {}
+        self.disk_quota = disk_quota
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._queued = set()
+        self._tasks = []
+
+    async def start(self):
+        for media_path, file_id, media_type in await self.db.get_pending_media():
+            self.submit(media_path, file_id, media_type=media_type)
+
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout: float = 30):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, media_path: str, file_id: str, file_size: int = None, media_type: str = None):
+        if media_path in self._queued:
+            return
+
+        priority = file_size if file_size is not None else UNKNOWN_SIZE_PRIORITY
+        self._queued.add(media_path)
+        self._queue.put_nowait((priority, next(self._counter), media_path, file_id, file_size, media_type))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            _, _, media_path, file_id, file_size, media_type = await self._queue.get()
+            try:
+                await self._download(media_path, file_id, file_size, media_type)
+            finally:
+                self._queued.discard(media_path)
+                self._queue.task_done()
+
+    def _fits_quota(self, file_size: int):
+        return not self.disk_quota or self.db.media_bytes + (file_size or 0) <= self.disk_quota
+
+    async def _download(self, media_path: str, file_id: str, file_size: int = None, media_type: str = None):
+        if await asyncio.to_thread(os.path.exists, media_path):
+            if not await self.db.set_media_status(media_path, 'done'):
+                await asyncio.to_thread(remove_files, [media_path])
+            return
+
+        max_size = self.size_limits.get(media_type, MAX_MEDIA_SIZE)
+        if (file_size and file_size > max_size) or not self._fits_quota(file_size):
+            await self.db.set_media_status(media_path, 'skipped')
+            return
+
+        for attempt in range(self.retries):
+            try:
+                await download_media(self.bot, file_id, media_path, max_size=max_size)
+                size = await asyncio.to_thread(os.path.getsize, media_path)
+                if not await self.db.set_media_status(media_path, 'done', size):
+                    await asyncio.to_thread(remove_files, [media_path])
+                return
+            except MediaTooLarge:
+                await self.db.set_media_status(media_path, 'skipped')
+                return
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                print(f"{datetime.now()}: Failed to download {media_path} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        await self.db.set_media_status(media_path, 'failed')
+
+def _move_file(old_path: str, new_path: str):
+    if not os.path.exists(old_path):
+        return False
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    os.replace(old_path, new_path)
+    return True
+
+async def migrate_media_layout(db):
+    moved = 0
+    for media_path, file_unique_id in await db.get_media_paths():
+        key, extension = os.path.splitext(os.path.basename(media_path))
+        new_path = media_path_for(file_unique_id or key, extension)
+        if new_path == media_path:
+            continue
+
+        if await asyncio.to_thread(_move_file, media_path, new_path):
+            moved += 1
+        await db.rename_media_path(media_path, new_path)
+
+    return moved
@@ -0,0 +1,197 @@
+import asyncio
+import time
+from datetime import datetime
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from utils import MESSAGE_LIMIT, chunk_digest, format_as_quote, format_diff_quotes, send_media_message, send_media_group_message
+
+SENDERS = {
+    "message": send_media_message,
+    "album": send_media_group_message
+}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Notifier:
+    def __init__(self, bot: Bot, db, rate: float = 1.0, burst: int = 20, retries: int = 3, backoff: float = 1.0,
+                 digest_window: float = 30, global_rate: float = 30.0):
+        self.bot = bot
+        self.db = db
+        self.retries = retries
+        self.backoff = backoff
+        self.digest_window = digest_window
+        self._digests = {}
+        self._digest_handles = {}
+        self.rate = rate
+        self.burst = burst
+        self.bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._buckets = {}
+        self._queues = {}
+        self._workers = {}
+        self._pending = set()
+        self._lease_task = None
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.latency = 0.0
+        self.send_time = 0.0
+
+    async def start(self):
+        await self._claim()
+        if self.db.outbox_lease:
+            self._lease_task = asyncio.create_task(self._renew_leases())
+
+    def _enqueue(self, notification_id: int, owner_id: int, kind: str, media_files, text: str):
+        self._pending.add(notification_id)
+        queue = self._queues.get(owner_id)
+        if queue is None:
+            queue = self._queues[owner_id] = asyncio.Queue()
+            if owner_id not in self._buckets:
+                self._buckets[owner_id] = TokenBucket(self.rate, self.burst)
+            self._workers[owner_id] = asyncio.create_task(self._worker(owner_id, queue))
+        queue.put_nowait((notification_id, kind, media_files, text, time.monotonic()))
+
+    async def _claim(self):
+        for notification_id, owner_id, kind, media_files, text in await self.db.get_notifications():
+            if notification_id not in self._pending:
+                self._enqueue(notification_id, owner_id, kind, media_files, text)
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(self.db.outbox_lease / 3)
+            try:
+                await self.db.renew_notifications(self._pending)
+                await self._claim()
+            except Exception as e:
+                print(f"{datetime.now()}: Failed to renew notification leases: {e}")
+
+    async def stop(self, timeout: float = 10):
+        for group in list(self._digests):
+            await self._flush_digest(group)
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in list(self._queues.values()))), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        tasks = [task for task in [self._lease_task, *self._workers.values()] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers.clear()
+        self._queues.clear()
+        self._lease_task = None
+
+    async def send(self, owner_id: int, media_files, text: str):
+        await self._submit(owner_id, "message", media_files, text)
+
+    async def send_album(self, owner_id: int, media_files, text: str):
+        await self._submit(owner_id, "album", media_files, text)
+
+    async def _submit(self, owner_id: int, kind: str, media_files, text: str):
+        notification_id = await self.db.add_notification(owner_id, kind, media_files, text)
+        self._enqueue(notification_id, owner_id, kind, media_files, text)
+
+    def add_digest(self, owner_id: int, group, header: str, entry_key, label: str, old_text: str, new_text: str = None):
+        group = (owner_id, group)
+        if group not in self._digests:
+            self._digests[group] = (header, {})
+            self._digest_handles[group] = asyncio.get_running_loop().call_later(
+                self.digest_window, lambda: asyncio.create_task(self._flush_digest(group))
+            )
+
+        entries = self._digests[group][1]
+        if entry_key in entries:
+            old_text = entries[entry_key][1]
+        entries[entry_key] = (label, old_text, new_text)
+
+    async def _flush_digest(self, group):
+        handle = self._digest_handles.pop(group, None)
+        if handle:
+            handle.cancel()
+        if group not in self._digests:
+            return
+
+        header, entries = self._digests.pop(group)
+        parts = []
+        for label, old_text, new_text in entries.values():
+            if new_text is None:
+                part = f"{label}\n{format_as_quote(old_text)}\n\n"
+            else:
+                old_quote, new_quote = format_diff_quotes(old_text, new_text)
+                part = f"{label}\n{old_quote}\n↓\n{new_quote}\n\n"
+                if len(part) > MESSAGE_LIMIT:
+                    part = f"{label}\n{format_as_quote(old_text)}\n↓\n{format_as_quote(new_text)}\n\n"
+            parts.append(part)
+
+        for chunk in chunk_digest(header, parts):
+            await self.send(group[0], [], chunk)
+
+    def stats(self):
+        return {
+            "queued": sum(queue.qsize() for queue in self._queues.values()),
+            "chats": len(self._queues),
+            "digests": len(self._digests),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "avg_latency": self.latency / self.sent if self.sent else 0.0,
+            "avg_send_time": self.send_time / self.sent if self.sent else 0.0
+        }
+
+    async def _worker(self, owner_id: int, queue: asyncio.Queue):
+        while not queue.empty():
+            notification_id, kind, media_files, text, queued_at = queue.get_nowait()
+            try:
+                await self._deliver(notification_id, owner_id, kind, media_files, text, queued_at)
+            finally:
+                self._pending.discard(notification_id)
+                queue.task_done()
+
+        del self._queues[owner_id]
+        del self._workers[owner_id]
+
+    async def _deliver(self, notification_id: int, owner_id: int, kind: str, media_files, text: str, queued_at: float):
+        attempt = 0
+        while attempt < self.retries:
+            await self._buckets[owner_id].acquire()
+            await self.bucket.acquire()
+            started = time.monotonic()
+            try:
+                await SENDERS[kind](self.bot, owner_id, media_files, text)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                attempt += 1
+                print(f"{datetime.now()}: Failed to send notification {notification_id} (attempt {attempt}): {e}")
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+
+            finished = time.monotonic()
+            self.sent += 1
+            self.send_time += finished - started
+            self.latency += finished - queued_at
+            await self.db.delete_notification(notification_id)
+            return
+
+        self.failed += 1
+        await self.db.delete_notification(notification_id)
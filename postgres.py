@@ -0,0 +1,912 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+import asyncpg
+from aiogram import types
+
+from storage import CLEANUP_BATCH_SIZE, STATS_TABLES, Storage, remove_empty_dirs
+from utils import MEDIA_DIR
+
+SCHEMA_LOCK = 7417
+SETTINGS_CHANNEL = "spybot_settings"
+CONNECTIONS_CHANNEL = "spybot_connections"
+USERS_CHANNEL = "spybot_users"
+OUTBOX_LEASE = 60
+
+DEFAULT_SETTINGS = (
+    ('notify_edited', 1),
+    ('notify_deleted', 1),
+    ('ignore_changes_below', 0),
+    ('digest_mode', 0)
+)
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_seen TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        owner_id BIGINT,
+        chat_id BIGINT,
+        message_id BIGINT,
+        user_id BIGINT,
+        text TEXT,
+        date TEXT,
+        is_forwarded INTEGER DEFAULT 0,
+        forward_from TEXT,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
+        media_group_id TEXT,
+        PRIMARY KEY (owner_id, chat_id, message_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS message_actions (
+        id BIGSERIAL PRIMARY KEY,
+        owner_id BIGINT,
+        chat_id BIGINT,
+        message_id BIGINT,
+        user_id BIGINT,
+        action_type TEXT,
+        old_text TEXT,
+        new_text TEXT,
+        action_date TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS media_files (
+        id BIGSERIAL PRIMARY KEY,
+        owner_id BIGINT,
+        chat_id BIGINT,
+        message_id BIGINT,
+        file_id TEXT,
+        file_unique_id TEXT,
+        media_type TEXT,
+        media_path TEXT,
+        status TEXT DEFAULT 'done'
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS media_store (
+        file_unique_id TEXT PRIMARY KEY,
+        media_path TEXT,
+        ref_count INTEGER DEFAULT 0,
+        size BIGINT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS business_connections (
+        id TEXT PRIMARY KEY,
+        owner_id BIGINT,
+        is_enabled INTEGER DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id BIGSERIAL PRIMARY KEY,
+        owner_id BIGINT,
+        kind TEXT,
+        media_files TEXT,
+        text TEXT,
+        created_at TEXT,
+        claimed_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS username_history (
+        user_id BIGINT,
+        username TEXT,
+        first_seen TEXT,
+        PRIMARY KEY (user_id, username)
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_username_history_username ON username_history (lower(username))",
+    '''
+    CREATE TABLE IF NOT EXISTS user_stats (
+        owner_id BIGINT,
+        user_id BIGINT,
+        messages BIGINT DEFAULT 0,
+        actions BIGINT DEFAULT 0,
+        media BIGINT DEFAULT 0,
+        PRIMARY KEY (owner_id, user_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS owner_stats (
+        owner_id BIGINT PRIMARY KEY,
+        messages BIGINT DEFAULT 0,
+        media BIGINT DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS media_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        bytes BIGINT DEFAULT 0
+    )
+    ''',
+    "ALTER TABLE message_actions ADD COLUMN IF NOT EXISTS user_id BIGINT",
+    "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS held_paths TEXT",
+    '''
+    UPDATE message_actions ma SET user_id = m.user_id
+    FROM messages m
+    WHERE ma.user_id IS NULL AND ma.owner_id = m.owner_id AND ma.chat_id = m.chat_id AND ma.message_id = m.message_id
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (owner_id, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (owner_id, message_id)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_media_group ON messages (owner_id, chat_id, media_group_id)",
+    "CREATE INDEX IF NOT EXISTS idx_message_actions_message ON message_actions (owner_id, chat_id, message_id, action_date)",
+    "CREATE INDEX IF NOT EXISTS idx_message_actions_user ON message_actions (owner_id, user_id, action_date, id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_media_files_message ON media_files (owner_id, chat_id, message_id, file_unique_id)",
+    "CREATE INDEX IF NOT EXISTS idx_media_files_path ON media_files (media_path)",
+    "CREATE INDEX IF NOT EXISTS idx_media_files_status ON media_files (status)",
+    "CREATE INDEX IF NOT EXISTS idx_media_store_path ON media_store (media_path)",
+    '''
+    CREATE OR REPLACE FUNCTION spybot_count_messages() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO user_stats (owner_id, user_id, messages) VALUES (NEW.owner_id, NEW.user_id, 1)
+            ON CONFLICT (owner_id, user_id) DO UPDATE SET messages = user_stats.messages + 1;
+            INSERT INTO owner_stats (owner_id, messages) VALUES (NEW.owner_id, 1)
+            ON CONFLICT (owner_id) DO UPDATE SET messages = owner_stats.messages + 1;
+        ELSE
+            UPDATE user_stats SET messages = messages - 1 WHERE owner_id = OLD.owner_id AND user_id = OLD.user_id;
+            UPDATE owner_stats SET messages = messages - 1 WHERE owner_id = OLD.owner_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION spybot_count_actions() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' AND NEW.user_id IS NOT NULL THEN
+            INSERT INTO user_stats (owner_id, user_id, actions) VALUES (NEW.owner_id, NEW.user_id, 1)
+            ON CONFLICT (owner_id, user_id) DO UPDATE SET actions = user_stats.actions + 1;
+        ELSIF TG_OP = 'DELETE' AND OLD.user_id IS NOT NULL THEN
+            UPDATE user_stats SET actions = actions - 1 WHERE owner_id = OLD.owner_id AND user_id = OLD.user_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION spybot_count_media() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO user_stats (owner_id, user_id, media)
+            SELECT owner_id, user_id, 1 FROM messages
+            WHERE owner_id = NEW.owner_id AND chat_id = NEW.chat_id AND message_id = NEW.message_id
+            ON CONFLICT (owner_id, user_id) DO UPDATE SET media = user_stats.media + 1;
+            INSERT INTO owner_stats (owner_id, media) VALUES (NEW.owner_id, 1)
+            ON CONFLICT (owner_id) DO UPDATE SET media = owner_stats.media + 1;
+        ELSE
+            UPDATE user_stats SET media = media - 1
+            WHERE owner_id = OLD.owner_id AND user_id = (
+                SELECT user_id FROM messages WHERE owner_id = OLD.owner_id AND chat_id = OLD.chat_id AND message_id = OLD.message_id
+            );
+            UPDATE owner_stats SET media = media - 1 WHERE owner_id = OLD.owner_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION spybot_count_media_bytes() RETURNS trigger AS $$
+    DECLARE
+        delta BIGINT := 0;
+    BEGIN
+        IF TG_OP != 'DELETE' THEN
+            delta := delta + COALESCE(NEW.size, 0);
+        END IF;
+        IF TG_OP != 'INSERT' THEN
+            delta := delta - COALESCE(OLD.size, 0);
+        END IF;
+        IF delta != 0 THEN
+            INSERT INTO media_stats (id, bytes) VALUES (1, delta)
+            ON CONFLICT (id) DO UPDATE SET bytes = media_stats.bytes + delta;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    "CREATE OR REPLACE TRIGGER stats_messages AFTER INSERT OR DELETE ON messages FOR EACH ROW EXECUTE FUNCTION spybot_count_messages()",
+    "CREATE OR REPLACE TRIGGER stats_actions AFTER INSERT OR DELETE ON message_actions FOR EACH ROW EXECUTE FUNCTION spybot_count_actions()",
+    "CREATE OR REPLACE TRIGGER stats_media AFTER INSERT OR DELETE ON media_files FOR EACH ROW EXECUTE FUNCTION spybot_count_media()",
+    "CREATE OR REPLACE TRIGGER stats_media_bytes AFTER INSERT OR UPDATE OF size OR DELETE ON media_store FOR EACH ROW EXECUTE FUNCTION spybot_count_media_bytes()",
+    "CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (to_tsvector('simple', text))",
+    "CREATE INDEX IF NOT EXISTS idx_message_actions_search ON message_actions USING GIN (to_tsvector('simple', old_text))",
+)
+
+class PostgresDatabase(Storage):
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10, lazy_media=False, prefetch_types=()):
+        super().__init__(lazy_media, prefetch_types)
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._listener = None
+        self.outbox_lease = OUTBOX_LEASE
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK)
+                missing = {
+                    row['name'] for row in await conn.fetch(
+                        "SELECT name FROM unnest($1::text[]) AS name WHERE to_regclass(name) IS NULL",
+                        ["owner_stats", "username_history", "media_stats"]
+                    )
+                }
+                for statement in SCHEMA:
+                    await conn.execute(statement)
+                if "username_history" in missing:
+                    await conn.execute("""
+                        INSERT INTO username_history (user_id, username, first_seen)
+                        SELECT id, username, first_seen FROM users WHERE username IS NOT NULL
+                        ON CONFLICT DO NOTHING
+                    """)
+                if "owner_stats" in missing:
+                    await self._rebuild_stats(conn)
+                if "media_stats" in missing:
+                    await self._rebuild_media_bytes(conn)
+                await conn.executemany(
+                    "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
+                    DEFAULT_SETTINGS
+                )
+
+            self.settings.load(await conn.fetch("SELECT key, value FROM settings"))
+            self.connections = {
+                row['id']: row['owner_id'] if row['is_enabled'] else None
+                for row in await conn.fetch("SELECT id, owner_id, is_enabled FROM business_connections")
+            }
+            self.media_bytes = await conn.fetchval("SELECT COALESCE((SELECT bytes FROM media_stats), 0)")
+
+        self._listener = await asyncpg.connect(self.dsn)
+        await self._listener.add_listener(SETTINGS_CHANNEL, self._on_setting)
+        await self._listener.add_listener(CONNECTIONS_CHANNEL, self._on_connection)
+        await self._listener.add_listener(USERS_CHANNEL, self._on_users)
+
+    async def close(self):
+        if self._listener:
+            await self._listener.close()
+            self._listener = None
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def flush(self):
+        pass
+
+    def _on_setting(self, conn, pid, channel, payload):
+        key, value = json.loads(payload)
+        self.settings.set(key, value)
+
+    def _on_connection(self, conn, pid, channel, payload):
+        connection_id, owner_id, is_enabled = json.loads(payload)
+        self.connections[connection_id] = owner_id if is_enabled else None
+
+    def _on_users(self, conn, pid, channel, payload):
+        self.users.clear()
+
+    async def save_message(self, owner_id: int, message: types.Message):
+        user, values, media_rows, saved_media, _ = self.parse_message(owner_id, message)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if self._user_changed(user):
+                    await conn.execute("""
+                        INSERT INTO users (id, username, first_seen) VALUES ($1, $2, $3)
+                        ON CONFLICT (id) DO UPDATE SET username = EXCLUDED.username
+                        WHERE users.username IS DISTINCT FROM EXCLUDED.username
+                    """, *user)
+                    if user[1]:
+                        await conn.execute(
+                            "INSERT INTO username_history (user_id, username, first_seen) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+                            *user
+                        )
+                await conn.execute("""
+                    INSERT INTO messages (owner_id, chat_id, message_id, user_id, text, date, is_forwarded,
+                                          forward_from, latitude, longitude, media_group_id)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+                    ON CONFLICT (owner_id, chat_id, message_id) DO UPDATE SET
+                        user_id = EXCLUDED.user_id,
+                        text = EXCLUDED.text,
+                        date = EXCLUDED.date,
+                        is_forwarded = EXCLUDED.is_forwarded,
+                        forward_from = EXCLUDED.forward_from,
+                        latitude = EXCLUDED.latitude,
+                        longitude = EXCLUDED.longitude,
+                        media_group_id = EXCLUDED.media_group_id
+                """, values['owner_id'], values['chat_id'], values['message_id'], values['user_id'], values['text'],
+                    values['date'], values['is_forwarded'], values['forward_from'], values['latitude'],
+                    values['longitude'], values['media_group_id'])
+
+                for media_row in media_rows:
+                    inserted = await conn.fetchval("""
+                        INSERT INTO media_files (owner_id, chat_id, message_id, file_id, file_unique_id, media_type, media_path, status)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                        ON CONFLICT (owner_id, chat_id, message_id, file_unique_id) DO NOTHING
+                        RETURNING id
+                    """, *media_row)
+
+                    if inserted:
+                        await conn.execute("""
+                            INSERT INTO media_store (file_unique_id, media_path, ref_count) VALUES ($1, $2, 1)
+                            ON CONFLICT (file_unique_id) DO UPDATE SET ref_count = media_store.ref_count + 1
+                        """, media_row[4], media_row[6])
+
+        return saved_media
+
+    async def _release_media(self, conn, rows, mark_released: bool = True):
+        unused_paths = []
+        references = {}
+        for _, file_unique_id, media_path in rows:
+            if file_unique_id:
+                references[file_unique_id] = references.get(file_unique_id, 0) + 1
+            else:
+                unused_paths.append(media_path)
+
+        if references:
+            released = await conn.fetch("""
+                UPDATE media_store SET ref_count = media_store.ref_count - r.count
+                FROM unnest($1::text[], $2::int[]) AS r(file_unique_id, count)
+                WHERE media_store.file_unique_id = r.file_unique_id
+                RETURNING media_store.media_path, media_store.size, media_store.ref_count
+            """, list(references), list(references.values()))
+            for row in released:
+                if row['ref_count'] <= 0:
+                    unused_paths.append(row['media_path'])
+                    self.media_bytes -= row['size'] or 0
+            await conn.execute(
+                "DELETE FROM media_store WHERE file_unique_id = ANY($1::text[]) AND ref_count <= 0",
+                list(references)
+            )
+
+        if mark_released:
+            await conn.execute(
+                "UPDATE media_files SET status = 'released' WHERE id = ANY($1::bigint[])",
+                [row[0] for row in rows]
+            )
+
+        return unused_paths
+
+    async def save_message_action(self, owner_id: int, chat_id: int, message_id: int, action_type: str, old_text: str, new_text: str = None):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if action_type == 'edit':
+                    await conn.execute(
+                        "UPDATE messages SET text = $1 WHERE owner_id = $2 AND chat_id = $3 AND message_id = $4",
+                        new_text, owner_id, chat_id, message_id
+                    )
+
+                await conn.execute("""
+                    INSERT INTO message_actions (owner_id, chat_id, message_id, user_id, action_type, old_text, new_text, action_date)
+                    VALUES ($1, $2, $3, (SELECT user_id FROM messages WHERE owner_id = $1 AND chat_id = $2 AND message_id = $3), $4, $5, $6, $7)
+                """, owner_id, chat_id, message_id, action_type, old_text, new_text, datetime.now().isoformat())
+
+    async def get_messages(self, owner_id: int, chat_id: int, message_ids):
+        message_ids = list(message_ids)
+        messages = {}
+
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT m.chat_id, m.message_id, m.user_id, m.text, m.date,
+                       m.is_forwarded, m.forward_from, m.latitude, m.longitude, m.media_group_id, u.username
+                FROM messages m
+                JOIN users u ON m.user_id = u.id
+                WHERE m.owner_id = $1 AND m.chat_id = $2 AND m.message_id = ANY($3::bigint[])
+            """, owner_id, chat_id, message_ids)
+
+            for row in rows:
+                messages[row['message_id']] = {
+                    "owner_id": owner_id,
+                    "chat_id": row['chat_id'],
+                    "message_id": row['message_id'],
+                    "user_id": row['user_id'],
+                    "text": row['text'],
+                    "date": row['date'],
+                    "is_forwarded": bool(row['is_forwarded']),
+                    "forward_from": row['forward_from'],
+                    "latitude": row['latitude'],
+                    "longitude": row['longitude'],
+                    "media_group_id": row['media_group_id'],
+                    "username": row['username'],
+                    "media_files": []
+                }
+
+            media_rows = await conn.fetch("""
+                SELECT message_id, media_type, media_path, file_id
+                FROM media_files
+                WHERE owner_id = $1 AND chat_id = $2 AND message_id = ANY($3::bigint[])
+                ORDER BY id
+            """, owner_id, chat_id, message_ids)
+
+        for message_id, media_type, media_path, file_id in media_rows:
+            if message_id in messages:
+                messages[message_id]["media_files"].append((media_type, media_path, file_id))
+
+        return messages
+
+    async def get_edit_history(self, owner_id: int, chat_id: int, message_id: int):
+        rows = await self.pool.fetch("""
+            SELECT old_text, action_date
+            FROM message_actions
+            WHERE owner_id = $1 AND chat_id = $2 AND message_id = $3 AND action_type = 'edit'
+            ORDER BY action_date ASC
+        """, owner_id, chat_id, message_id)
+        return [tuple(row) for row in rows]
+
+    async def search_messages(self, owner_id: int, query: str, limit: int = 5, offset: int = 0):
+        rows = await self.pool.fetch("""
+            WITH q AS (
+                SELECT plainto_tsquery('simple', $2) AS query
+            ),
+            hits AS (
+                SELECT m.chat_id, m.message_id, 'message' AS source, m.text, m.date,
+                       ts_rank(to_tsvector('simple', m.text), q.query) AS rank
+                FROM messages m, q
+                WHERE m.owner_id = $1 AND to_tsvector('simple', m.text) @@ q.query
+                AND NOT EXISTS (
+                    SELECT 1 FROM message_actions
+                    WHERE owner_id = m.owner_id AND chat_id = m.chat_id AND message_id = m.message_id AND action_type = 'delete'
+                )
+                UNION ALL
+                SELECT a.chat_id, a.message_id, a.action_type, a.old_text, a.action_date,
+                       ts_rank(to_tsvector('simple', a.old_text), q.query)
+                FROM message_actions a, q
+                WHERE a.owner_id = $1 AND to_tsvector('simple', a.old_text) @@ q.query
+            ),
+            best AS (
+                SELECT DISTINCT ON (chat_id, message_id) *
+                FROM hits
+                ORDER BY chat_id, message_id, rank DESC
+            )
+            SELECT b.chat_id, b.message_id, b.source, b.text, b.date, u.username
+            FROM best b
+            JOIN messages m ON m.owner_id = $1 AND m.chat_id = b.chat_id AND m.message_id = b.message_id
+            JOIN users u ON u.id = m.user_id
+            ORDER BY b.rank DESC
+            LIMIT $3 OFFSET $4
+        """, owner_id, query, limit, offset)
+        return [tuple(row) for row in rows]
+
+    async def resolve_user(self, owner_id: int, user: str):
+        return await self._resolve_user(self.pool, owner_id, user)
+
+    async def _resolve_user(self, conn, owner_id: int, user: str):
+        user = user.lstrip("@")
+        if user.isdigit():
+            return await conn.fetchval("SELECT user_id FROM user_stats WHERE owner_id = $1 AND user_id = $2", owner_id, int(user))
+        return await conn.fetchval("""
+            SELECT h.user_id FROM username_history h
+            JOIN users u ON u.id = h.user_id
+            JOIN user_stats s ON s.owner_id = $1 AND s.user_id = h.user_id
+            WHERE lower(h.username) = lower($2)
+            ORDER BY lower(u.username) = lower(h.username) DESC NULLS LAST, h.first_seen DESC
+            LIMIT 1
+        """, owner_id, user)
+
+    async def get_username(self, user_id: int):
+        return await self.pool.fetchval("SELECT username FROM users WHERE id = $1", user_id)
+
+    async def get_user_actions(self, owner_id: int, username: str, limit: int = 5, before: int = None, after: int = None):
+        if after is not None:
+            cursor_filter, order, cursor_id = "AND (ma.action_date, ma.id) > (SELECT action_date, id FROM message_actions WHERE id = $4)", "ASC", after
+        elif before is not None:
+            cursor_filter, order, cursor_id = "AND (ma.action_date, ma.id) < (SELECT action_date, id FROM message_actions WHERE id = $4)", "DESC", before
+        else:
+            cursor_filter, order, cursor_id = "", "DESC", None
+
+        async with self.pool.acquire() as conn:
+            user_id = await self._resolve_user(conn, owner_id, username)
+            if user_id is None:
+                return None, []
+
+            rows = await conn.fetch(f"""
+                SELECT
+                    ma.id,
+                    ma.action_type,
+                    ma.old_text,
+                    ma.new_text,
+                    ma.action_date,
+                    m.is_forwarded,
+                    m.forward_from,
+                    m.chat_id,
+                    m.message_id,
+                    m.latitude,
+                    m.longitude
+                FROM message_actions ma
+                JOIN messages m ON ma.owner_id = m.owner_id AND ma.chat_id = m.chat_id AND ma.message_id = m.message_id
+                WHERE ma.owner_id = $1 AND ma.user_id = $2 {cursor_filter}
+                ORDER BY ma.action_date {order}, ma.id {order}
+                LIMIT $3
+            """, owner_id, user_id, limit, *([cursor_id] if cursor_id is not None else []))
+
+        if order == "ASC":
+            rows.reverse()
+
+        actions = []
+        for action_id, action_type, old_text, new_text, action_date, is_forwarded, forward_from, chat_id, message_id, latitude, longitude in rows:
+            display_text = old_text if action_type == 'delete' else new_text
+            action_name = 'deleted' if action_type == 'delete' else 'edited'
+
+            actions.append((action_id, action_name, display_text, action_date, bool(is_forwarded), forward_from, chat_id, message_id, latitude, longitude))
+
+        return user_id, actions
+
+    async def delete_messages(self, owner_id: int, chat_id: int, message_ids):
+        message_ids = list(message_ids)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO message_actions (owner_id, chat_id, message_id, user_id, action_type, old_text, new_text, action_date)
+                    SELECT owner_id, chat_id, message_id, user_id, 'delete', text, NULL, $1
+                    FROM messages
+                    WHERE owner_id = $2 AND chat_id = $3 AND message_id = ANY($4::bigint[])
+                """, datetime.now().isoformat(), owner_id, chat_id, message_ids)
+
+                rows = await conn.fetch("""
+                    SELECT id, file_unique_id, media_path FROM media_files
+                    WHERE owner_id = $1 AND chat_id = $2 AND message_id = ANY($3::bigint[]) AND status != 'released'
+                """, owner_id, chat_id, message_ids)
+                media_paths = await self._release_media(conn, rows)
+
+        await self._remove_files(media_paths)
+        return media_paths
+
+    async def set_media_status(self, media_path: str, status: str, size: int = None):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "UPDATE media_files SET status = $1 WHERE media_path = $2 AND status != 'released'",
+                    status, media_path
+                )
+                if size is not None:
+                    updated = await conn.execute(
+                        "UPDATE media_store SET size = $1 WHERE media_path = $2 AND size IS NULL",
+                        size, media_path
+                    )
+                    if updated != "UPDATE 0":
+                        self.media_bytes += size
+                return await conn.fetchval("""
+                    SELECT EXISTS (SELECT 1 FROM media_store WHERE media_path = $1)
+                        OR EXISTS (SELECT 1 FROM media_files WHERE media_path = $1 AND file_unique_id IS NULL AND status != 'released')
+                """, media_path)
+
+    async def get_media_paths(self):
+        rows = await self.pool.fetch("""
+            SELECT media_path, file_unique_id FROM media_store
+            UNION
+            SELECT media_path, NULL FROM media_files WHERE file_unique_id IS NULL AND media_path != ''
+        """)
+        return [tuple(row) for row in rows]
+
+    async def rename_media_path(self, old_path: str, new_path: str):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("UPDATE media_store SET media_path = $1 WHERE media_path = $2", new_path, old_path)
+                await conn.execute("UPDATE media_files SET media_path = $1 WHERE media_path = $2", new_path, old_path)
+
+    async def get_pending_media(self):
+        rows = await self.pool.fetch(
+            "SELECT media_path, MIN(file_id), MIN(media_type) FROM media_files WHERE status = 'pending' GROUP BY media_path"
+        )
+        return [tuple(row) for row in rows]
+
+    async def add_notification(self, owner_id: int, kind: str, media_files, text: str):
+        media_paths = list(dict.fromkeys(media_path for _, media_path, _ in media_files if media_path))
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                held = await conn.fetch(
+                    "UPDATE media_store SET ref_count = ref_count + 1 WHERE media_path = ANY($1::text[]) RETURNING media_path",
+                    media_paths
+                )
+                return await conn.fetchval(
+                    "INSERT INTO outbox (owner_id, kind, media_files, text, created_at, held_paths) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id",
+                    owner_id, kind, json.dumps(media_files), text, datetime.now().isoformat(), json.dumps([row['media_path'] for row in held])
+                )
+
+    async def delete_notification(self, notification_id: int):
+        unused_paths = []
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                held_paths = await conn.fetchval("DELETE FROM outbox WHERE id = $1 RETURNING held_paths", notification_id)
+                if held_paths:
+                    released = await conn.fetch("""
+                        UPDATE media_store SET ref_count = ref_count - 1 WHERE media_path = ANY($1::text[])
+                        RETURNING media_path, size, ref_count
+                    """, json.loads(held_paths))
+                    for row in released:
+                        if row['ref_count'] <= 0:
+                            unused_paths.append(row['media_path'])
+                            self.media_bytes -= row['size'] or 0
+                    await conn.execute(
+                        "DELETE FROM media_store WHERE media_path = ANY($1::text[]) AND ref_count <= 0",
+                        json.loads(held_paths)
+                    )
+        await self._remove_files(unused_paths)
+
+    async def renew_notifications(self, notification_ids):
+        if notification_ids:
+            await self.pool.execute("UPDATE outbox SET claimed_at = now() WHERE id = ANY($1::bigint[])", list(notification_ids))
+
+    async def get_notifications(self):
+        rows = await self.pool.fetch("""
+            WITH claimed AS (
+                UPDATE outbox SET claimed_at = now()
+                WHERE claimed_at < now() - make_interval(secs => $1)
+                RETURNING id, owner_id, kind, media_files, text
+            )
+            SELECT * FROM claimed ORDER BY id
+        """, self.outbox_lease)
+        return [
+            (notification_id, owner_id, kind, [tuple(media_file) for media_file in json.loads(media_files)], text)
+            for notification_id, owner_id, kind, media_files, text in rows
+        ]
+
+    async def save_connection(self, connection_id: str, owner_id: int, is_enabled: bool = True):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO business_connections (id, owner_id, is_enabled) VALUES ($1, $2, $3)
+                    ON CONFLICT (id) DO UPDATE SET owner_id = EXCLUDED.owner_id, is_enabled = EXCLUDED.is_enabled
+                """, connection_id, owner_id, int(is_enabled))
+                await conn.execute(
+                    "SELECT pg_notify($1, $2)",
+                    CONNECTIONS_CHANNEL, json.dumps([connection_id, owner_id, bool(is_enabled)])
+                )
+        self.connections[connection_id] = owner_id if is_enabled else None
+
+    async def _write_setting(self, key: str, value: int):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO settings (key, value) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                """, key, value)
+                await conn.execute("SELECT pg_notify($1, $2)", SETTINGS_CHANNEL, json.dumps([key, value]))
+
+    async def get_stats(self, owner_id: int):
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT
+                    COALESCE((SELECT messages FROM owner_stats WHERE owner_id = $1), 0),
+                    COALESCE((SELECT media FROM owner_stats WHERE owner_id = $1), 0),
+                    COALESCE((SELECT bytes FROM media_stats), 0)
+            """, owner_id)
+            total_messages, total_media, self.media_bytes = row
+
+        return {
+            "total_messages": total_messages,
+            "total_media": total_media,
+            "media_bytes": self.media_bytes
+        }
+
+    async def rebuild_stats(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("LOCK TABLE messages, message_actions, media_files, media_store IN SHARE MODE")
+                drift = await self._rebuild_stats(conn)
+                drift += await self._rebuild_media_bytes(conn)
+                self.media_bytes = await conn.fetchval("SELECT bytes FROM media_stats")
+                return drift
+
+    async def _rebuild_stats(self, conn):
+        drift = 0
+        for table, (keys, counters, query) in STATS_TABLES.items():
+            columns = ', '.join(keys + counters)
+            stored = f"SELECT {columns} FROM {table} WHERE {' OR '.join(f'{counter} != 0' for counter in counters)}"
+            drift += await conn.fetchval(f"""
+                SELECT COUNT(*) FROM (
+                    SELECT {', '.join(keys)} FROM (({query}) EXCEPT {stored}) AS missing
+                    UNION
+                    SELECT {', '.join(keys)} FROM ({stored} EXCEPT ({query})) AS stale
+                ) AS drift
+            """)
+
+            await conn.execute(f"DELETE FROM {table}")
+            await conn.execute(f"INSERT INTO {table} ({columns}) {query}")
+        return drift
+
+    async def _rebuild_media_bytes(self, conn):
+        stored = await conn.fetchval("SELECT COALESCE((SELECT bytes FROM media_stats), 0)")
+        actual = await conn.fetchval("SELECT COALESCE(SUM(size), 0) FROM media_store")
+        await conn.execute("""
+            INSERT INTO media_stats (id, bytes) VALUES (1, $1)
+            ON CONFLICT (id) DO UPDATE SET bytes = EXCLUDED.bytes
+        """, actual)
+        return int(stored != actual)
+
+    async def cleanup_old_messages(self, hours=24, batch_size=CLEANUP_BATCH_SIZE):
+        cutoff_time = (datetime.now() - timedelta(hours=hours)).isoformat()
+
+        deleted_count = 0
+        while True:
+            count, media_paths = await self._delete_expired_batch(cutoff_time, batch_size)
+            deleted_count += count
+
+            await self._remove_files(media_paths)
+
+            if count < batch_size:
+                break
+
+        return deleted_count
+
+    async def _delete_expired_batch(self, cutoff_time: str, batch_size: int):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                expired = await conn.fetch("""
+                    SELECT owner_id, chat_id, message_id FROM messages
+                    WHERE date < $1
+                    LIMIT $2
+                    FOR UPDATE SKIP LOCKED
+                """, cutoff_time, batch_size)
+                if not expired:
+                    return 0, []
+
+                keys = [list(column) for column in zip(*expired)]
+                rows = await conn.fetch("""
+                    SELECT id, file_unique_id, media_path FROM media_files
+                    WHERE (owner_id, chat_id, message_id) IN (
+                        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+                    ) AND status != 'released'
+                """, *keys)
+                media_paths = await self._release_media(conn, rows, mark_released=False)
+
+                for table in ("media_files", "message_actions", "messages"):
+                    await conn.execute(f"""
+                        DELETE FROM {table}
+                        WHERE (owner_id, chat_id, message_id) IN (
+                            SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+                        )
+                    """, *keys)
+
+        return len(expired), media_paths
+
+    async def cleanup_all(self, owner_id: int):
+        self.users.clear()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow("SELECT messages, media FROM owner_stats WHERE owner_id = $1", owner_id)
+                messages_count, files_count = row or (0, 0)
+
+                rows = await conn.fetch(
+                    "SELECT id, file_unique_id, media_path FROM media_files WHERE owner_id = $1 AND status != 'released'",
+                    owner_id
+                )
+                media_paths = await self._release_media(conn, rows, mark_released=False)
+
+                for table in ("message_actions", "media_files", "messages"):
+                    await conn.execute(f"DELETE FROM {table} WHERE owner_id = $1", owner_id)
+                await conn.execute("DELETE FROM users WHERE id NOT IN (SELECT user_id FROM messages)")
+                await conn.execute("DELETE FROM username_history WHERE user_id NOT IN (SELECT id FROM users)")
+                await conn.execute("SELECT pg_notify($1, '')", USERS_CHANNEL)
+
+        await self._remove_files(media_paths)
+        await asyncio.get_running_loop().run_in_executor(None, remove_empty_dirs, MEDIA_DIR)
+
+        return messages_count, files_count
+
+    async def get_user_stats(self, owner_id: int, username: str):
+        async with self.pool.acquire() as conn:
+            user_id = await self._resolve_user(conn, owner_id, username)
+            if user_id is None:
+                return None
+
+            row = await conn.fetchrow("""
+                SELECT
+                    u.username,
+                    COALESCE(s.messages, 0) AS total_messages,
+                    COALESCE(s.actions, 0) AS total_actions,
+                    COALESCE(s.media, 0) AS total_media
+                FROM users u
+                LEFT JOIN user_stats s ON s.owner_id = $1 AND s.user_id = u.id
+                WHERE u.id = $2
+            """, owner_id, user_id)
+
+        return {
+            "user_id": user_id,
+            "username": row['username'],
+            "total_messages": row['total_messages'],
+            "total_actions": row['total_actions'],
+            "total_media": row['total_media'],
+            "notify_enabled": self.get_user_notify(owner_id, user_id)
+        }
+
+    async def cleanup_user_data(self, owner_id: int, username: str):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                user_id = await self._resolve_user(conn, owner_id, username)
+                if user_id is None:
+                    return 0, 0
+
+                rows = await conn.fetch("""
+                    SELECT mf.id, mf.file_unique_id, mf.media_path FROM media_files mf
+                    JOIN messages m ON mf.owner_id = m.owner_id AND mf.chat_id = m.chat_id AND mf.message_id = m.message_id
+                    WHERE m.owner_id = $1 AND m.user_id = $2 AND mf.status != 'released'
+                """, owner_id, user_id)
+                media_paths = await self._release_media(conn, rows, mark_released=False)
+
+                for table in ("media_files", "message_actions"):
+                    await conn.execute(f"""
+                        DELETE FROM {table}
+                        WHERE (owner_id, chat_id, message_id) IN (
+                            SELECT owner_id, chat_id, message_id FROM messages WHERE owner_id = $1 AND user_id = $2
+                        )
+                    """, owner_id, user_id)
+                deleted = await conn.execute("DELETE FROM messages WHERE owner_id = $1 AND user_id = $2", owner_id, user_id)
+
+        deleted_files = await self._remove_files(media_paths)
+        return int(deleted.split()[-1]), deleted_files
+
+    async def get_message_history(self, owner_id: int, message_id: int):
+        async with self.pool.acquire() as conn:
+            message_info = await conn.fetchrow("""
+                SELECT
+                    COALESCE(
+                        (SELECT old_text
+                         FROM message_actions
+                         WHERE owner_id = m.owner_id
+                         AND chat_id = m.chat_id
+                         AND message_id = m.message_id
+                         AND action_type = 'edit'
+                         ORDER BY action_date ASC
+                         LIMIT 1),
+                        m.text
+                    ) as original_text,
+                    m.chat_id,
+                    m.date,
+                    m.is_forwarded,
+                    m.forward_from,
+                    u.username,
+                    m.latitude,
+                    m.longitude
+                FROM messages m
+                JOIN users u ON m.user_id = u.id
+                WHERE m.owner_id = $1 AND m.message_id = $2
+                LIMIT 1
+            """, owner_id, message_id)
+
+            if not message_info:
+                return None
+
+            chat_id = message_info['chat_id']
+            actions = await conn.fetch("""
+                SELECT action_type, old_text, new_text, action_date
+                FROM message_actions
+                WHERE owner_id = $1 AND chat_id = $2 AND message_id = $3
+                ORDER BY action_date ASC
+            """, owner_id, chat_id, message_id)
+
+            media_files = await conn.fetch("""
+                SELECT media_type, media_path, file_id
+                FROM media_files
+                WHERE owner_id = $1 AND chat_id = $2 AND message_id = $3
+            """, owner_id, chat_id, message_id)
+
+        return {
+            'original_text': message_info['original_text'],
+            'chat_id': chat_id,
+            'date': message_info['date'],
+            'is_forwarded': message_info['is_forwarded'],
+            'forward_from': message_info['forward_from'],
+            'username': message_info['username'],
+            'actions': [tuple(row) for row in actions],
+            'media_files': [tuple(row) for row in media_files],
+            'latitude': message_info['latitude'],
+            'longitude': message_info['longitude']
+        }
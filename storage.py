@@ -0,0 +1,361 @@
+import os
+import asyncio
+from abc import ABC, abstractmethod
+from datetime import datetime
+from aiogram import types
+
+from utils import media_path_for
+
+CLEANUP_BATCH_SIZE = 5000
+
+STATS_TABLES = {
+    "user_stats": (("owner_id", "user_id"), ("messages", "actions", "media"), '''
+        SELECT owner_id, user_id, SUM(messages), SUM(actions), SUM(media) FROM (
+            SELECT owner_id, user_id, COUNT(*) AS messages, 0 AS actions, 0 AS media
+            FROM messages GROUP BY owner_id, user_id
+            UNION ALL
+            SELECT owner_id, user_id, 0, COUNT(*), 0
+            FROM message_actions WHERE user_id IS NOT NULL GROUP BY owner_id, user_id
+            UNION ALL
+            SELECT mf.owner_id, m.user_id, 0, 0, COUNT(*)
+            FROM media_files mf
+            JOIN messages m ON mf.owner_id = m.owner_id AND mf.chat_id = m.chat_id AND mf.message_id = m.message_id
+            GROUP BY mf.owner_id, m.user_id
+        ) AS counts
+        GROUP BY owner_id, user_id
+    '''),
+    "owner_stats": (("owner_id",), ("messages", "media"), '''
+        SELECT owner_id, SUM(messages), SUM(media) FROM (
+            SELECT owner_id, COUNT(*) AS messages, 0 AS media FROM messages GROUP BY owner_id
+            UNION ALL
+            SELECT owner_id, 0, COUNT(*) FROM media_files GROUP BY owner_id
+        ) AS counts
+        GROUP BY owner_id
+    ''')
+}
+
+def get_extension_from_mime(mime_type: str) -> str:
+    mime_to_ext = {
+        'image/jpeg': '.jpg',
+        'image/png': '.png',
+        'image/gif': '.gif',
+        'video/mp4': '.mp4',
+        'audio/mpeg': '.mp3',
+        'audio/ogg': '.ogg',
+        'application/pdf': '.pdf'
+    }
+    return mime_to_ext.get(mime_type, '')
+    
+def get_file_extension(file_name: str) -> str:
+    if not file_name:
+        return ''
+    parts = file_name.rsplit('.', 1)
+    if len(parts) > 1:
+        return f".{parts[1].lower()}"
+    return ''
+
+def remove_files(paths):
+    removed = 0
+    for path in paths:
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def remove_empty_dirs(root: str):
+    if not os.path.isdir(root):
+        return
+    for path, _, _ in sorted(os.walk(root), key=lambda entry: len(entry[0]), reverse=True):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+class SettingsCache:
+    def __init__(self):
+        self._values = {}
+
+    def load(self, rows):
+        self._values = {key: value for key, value in rows}
+
+    def get(self, key: str, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key: str, value: int):
+        self._values[key] = value
+
+class Storage(ABC):
+    def __init__(self, lazy_media=False, prefetch_types=()):
+        self.lazy_media = lazy_media
+        self.prefetch_types = set(prefetch_types)
+        self.media_bytes = 0
+        self.settings = SettingsCache()
+        self.connections = {}
+        self.users = {}
+        self.outbox_lease = None
+
+    async def connect(self):
+        pass
+
+    def cache_stats(self):
+        return None
+
+    async def renew_notifications(self, notification_ids):
+        pass
+
+    def parse_message(self, owner_id: int, message: types.Message):
+        is_forwarded = 0
+        forward_from = ""
+
+        if message.forward_from:
+            is_forwarded = 1
+            if message.forward_from.username:
+                forward_from = f"@{message.forward_from.username}"
+            else:
+                forward_from = message.forward_from.full_name
+        elif message.forward_from_chat:
+            is_forwarded = 1
+            if message.forward_from_chat.username:
+                forward_from = f"@{message.forward_from_chat.username}"
+            else:
+                forward_from = message.forward_from_chat.title
+        elif message.forward_sender_name:
+            is_forwarded = 1
+            forward_from = message.forward_sender_name
+
+        text = message.md_text or message.caption or " "
+
+        latitude = None
+        longitude = None
+        if message.location and not message.location.live_period:
+            latitude = message.location.latitude
+            longitude = message.location.longitude
+            if not text or text == " ":
+                text = f"📍 {latitude}, {longitude}"
+
+        values = {
+            'owner_id': owner_id,
+            'chat_id': message.chat.id,
+            'message_id': message.message_id,
+            'user_id': message.from_user.id,
+            'text': text,
+            'date': message.date.isoformat(),
+            'is_forwarded': is_forwarded,
+            'forward_from': forward_from,
+            'latitude': latitude,
+            'longitude': longitude,
+            'media_group_id': message.media_group_id
+        }
+
+        media_files = []
+        if message.photo:
+            largest_photo = message.photo[-1]
+            media_files.append(("photo", largest_photo, '.jpg'))
+        if message.video:
+            ext = get_extension_from_mime(message.video.mime_type) or get_file_extension(message.video.file_name) or '.mp4'
+            media_files.append(("video", message.video, ext))
+        if message.video_note:
+            media_files.append(("video_note", message.video_note, '.mp4'))
+        if message.voice:
+            ext = get_extension_from_mime(message.voice.mime_type) or '.ogg'
+            media_files.append(("voice", message.voice, ext))
+        if message.audio:
+            ext = get_extension_from_mime(message.audio.mime_type) or get_file_extension(message.audio.file_name) or '.mp3'
+            media_files.append(("audio", message.audio, ext))
+        if message.animation:
+            ext = get_extension_from_mime(message.animation.mime_type) or '.gif'
+            media_files.append(("animation", message.animation, ext))
+        if message.document and not message.animation:
+            if message.document.mime_type == 'image/gif':
+                media_files.append(("animation", message.document, '.gif'))
+            else:
+                ext = get_extension_from_mime(message.document.mime_type) or get_file_extension(message.document.file_name) or ''
+                media_files.append(("document", message.document, ext))
+        if message.sticker:
+            media_files.append(("sticker", message.sticker, '.webp'))
+
+        saved_media = []
+        media_rows = []
+        cached_media = []
+        for media_type, media, extension in media_files:
+            media_path = media_path_for(media.file_unique_id, extension)
+            status = 'remote' if self.lazy_media and media_type not in self.prefetch_types else 'pending'
+
+            media_rows.append((owner_id, values['chat_id'], values['message_id'], media.file_id, media.file_unique_id, media_type, media_path, status))
+            if status == 'pending':
+                saved_media.append((media_path, media.file_id, media.file_size, media_type))
+            cached_media.append((media_type, media_path, media.file_id))
+
+        user = (message.from_user.id, message.from_user.username, datetime.now().isoformat())
+        return user, values, media_rows, saved_media, cached_media
+
+    def _user_changed(self, user):
+        user_id, username, _ = user
+        if user_id in self.users and self.users[user_id] == username:
+            return False
+        self.users[user_id] = username
+        return True
+
+    def has_connection(self, connection_id: str):
+        return connection_id in self.connections
+
+    def get_connection_owner(self, connection_id: str):
+        return self.connections.get(connection_id)
+
+    def _setting(self, owner_id: int, key: str, default: int):
+        return self.settings.get(f"{owner_id}:{key}", self.settings.get(key, default))
+
+    def get_settings(self, owner_id: int):
+        return {
+            "notify_edited": bool(self._setting(owner_id, "notify_edited", 1)),
+            "notify_deleted": bool(self._setting(owner_id, "notify_deleted", 1)),
+            "ignore_changes_below": int(self._setting(owner_id, "ignore_changes_below", 0)),
+            "digest_mode": bool(self._setting(owner_id, "digest_mode", 0))
+        }
+
+    def get_user_notify(self, owner_id: int, user_id: int):
+        return bool(self._setting(owner_id, f"notify_user_{user_id}", 1))
+
+    async def _update_setting(self, owner_id: int, key: str, value: int):
+        await self._write_setting(f"{owner_id}:{key}", value)
+        self.settings.set(f"{owner_id}:{key}", value)
+
+    async def toggle_setting(self, owner_id: int, key: str):
+        await self._update_setting(owner_id, key, 1 - self._setting(owner_id, key, 1))
+
+    async def set_ignore_changes_below(self, owner_id: int, amount: int):
+        await self._update_setting(owner_id, 'ignore_changes_below', amount)
+
+    async def get_message(self, owner_id: int, chat_id: int, message_id: int):
+        messages = await self.get_messages(owner_id, chat_id, [message_id])
+        return messages.get(message_id)
+
+    async def _remove_files(self, paths):
+        if not paths:
+            return 0
+        return await asyncio.get_running_loop().run_in_executor(None, remove_files, paths)
+
+    async def delete_message(self, owner_id: int, chat_id: int, message_id: int):
+        return await self.delete_messages(owner_id, chat_id, [message_id])
+
+    async def toggle_user_notify(self, owner_id: int, user_id: int):
+        await self.toggle_setting(owner_id, f"notify_user_{user_id}")
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def flush(self):
+        pass
+
+    @abstractmethod
+    async def save_message(self, owner_id: int, message: types.Message):
+        pass
+
+    @abstractmethod
+    async def save_message_action(self, owner_id: int, chat_id: int, message_id: int, action_type: str, old_text: str, new_text: str = None):
+        pass
+
+    @abstractmethod
+    async def get_messages(self, owner_id: int, chat_id: int, message_ids):
+        pass
+
+    @abstractmethod
+    async def get_edit_history(self, owner_id: int, chat_id: int, message_id: int):
+        pass
+
+    @abstractmethod
+    async def get_message_history(self, owner_id: int, message_id: int):
+        pass
+
+    @abstractmethod
+    async def search_messages(self, owner_id: int, query: str, limit: int = 5, offset: int = 0):
+        pass
+
+    @abstractmethod
+    async def resolve_user(self, owner_id: int, user: str):
+        pass
+
+    @abstractmethod
+    async def get_username(self, user_id: int):
+        pass
+
+    @abstractmethod
+    async def get_user_actions(self, owner_id: int, username: str, limit: int = 5, before: int = None, after: int = None):
+        pass
+
+    @abstractmethod
+    async def get_user_stats(self, owner_id: int, username: str):
+        pass
+
+    @abstractmethod
+    async def get_stats(self, owner_id: int):
+        pass
+
+    @abstractmethod
+    async def delete_messages(self, owner_id: int, chat_id: int, message_ids):
+        pass
+
+    @abstractmethod
+    async def rebuild_stats(self):
+        pass
+
+    @abstractmethod
+    async def cleanup_old_messages(self, hours=24, batch_size=CLEANUP_BATCH_SIZE):
+        pass
+
+    @abstractmethod
+    async def cleanup_all(self, owner_id: int):
+        pass
+
+    @abstractmethod
+    async def cleanup_user_data(self, owner_id: int, username: str):
+        pass
+
+    @abstractmethod
+    async def set_media_status(self, media_path: str, status: str, size: int = None):
+        pass
+
+    @abstractmethod
+    async def get_media_paths(self):
+        pass
+
+    @abstractmethod
+    async def rename_media_path(self, old_path: str, new_path: str):
+        pass
+
+    @abstractmethod
+    async def get_pending_media(self):
+        pass
+
+    @abstractmethod
+    async def add_notification(self, owner_id: int, kind: str, media_files, text: str):
+        pass
+
+    @abstractmethod
+    async def delete_notification(self, notification_id: int):
+        pass
+
+    @abstractmethod
+    async def get_notifications(self):
+        pass
+
+    @abstractmethod
+    async def _write_setting(self, key: str, value: int):
+        pass
+
+    @abstractmethod
+    async def save_connection(self, connection_id: str, owner_id: int, is_enabled: bool = True):
+        pass
+
+def create_storage(url: str = "", **options):
+    if url.startswith(("postgres://", "postgresql://")):
+        from postgres import PostgresDatabase
+        return PostgresDatabase(url, **options)
+
+    from database import Database
+    return Database(url or "messages.db", **options)
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+from aiogram import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import create_storage
+
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+BACKENDS = ["sqlite"] + (["postgres"] if DATABASE_URL.startswith(("postgres://", "postgresql://")) else [])
+
+async def _reset_postgres(db):
+    async with db.pool.acquire() as conn:
+        tables = await conn.fetch("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()")
+        await conn.execute(f"TRUNCATE {', '.join(row['tablename'] for row in tables)} RESTART IDENTITY")
+    db.settings.load([])
+    db.connections.clear()
+    db.users.clear()
+    db.media_bytes = 0
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return DATABASE_URL if request.param == "postgres" else str(tmp_path / "messages.db")
+
+@pytest.fixture
+def run_storage(backend):
+    def run(scenario, reset=True):
+        async def main():
+            db = create_storage(backend)
+            await db.connect()
+            if reset and backend == DATABASE_URL:
+                await _reset_postgres(db)
+            try:
+                return await scenario(db)
+            finally:
+                await db.close()
+        return asyncio.run(main())
+    return run
+
+@pytest.fixture
+def make_message():
+    def make(message_id, text="hello", user_id=42, username="alice", chat_id=42, photo=None):
+        values = dict(
+            message_id=message_id,
+            date=datetime.now(timezone.utc),
+            chat=types.Chat(id=chat_id, type="private"),
+            from_user=types.User(id=user_id, is_bot=False, first_name="Test", username=username),
+            text=text
+        )
+        if photo:
+            values["photo"] = [types.PhotoSize(file_id=photo, file_unique_id=f"unique-{photo}", width=1, height=1, file_size=100)]
+        return types.Message(**values)
+    return make
@@ -0,0 +1,66 @@
+import asyncio
+import os
+
+import notifier
+from notifier import Notifier
+from utils import MESSAGE_LIMIT
+
+OWNER = 77
+CHAT = 42
+
+def test_deleted_media_survives_until_delivery(run_storage, make_message, monkeypatch):
+    delivered = []
+    release = asyncio.Event()
+
+    async def fake_send(bot, chat_id, media_files, text, reply_to_message_id=None):
+        await release.wait()
+        delivered.append([os.path.exists(media_path) for _, media_path, _ in media_files])
+
+    monkeypatch.setitem(notifier.SENDERS, "message", fake_send)
+
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, "photo", photo="p"))
+        media_files = (await db.get_message(OWNER, CHAT, 1))["media_files"]
+        media_path = media_files[0][1]
+        os.makedirs(os.path.dirname(media_path), exist_ok=True)
+        with open(media_path, "wb") as file:
+            file.write(b"x" * 10)
+        await db.set_media_status(media_path, 'done', 10)
+
+        queue = Notifier(None, db)
+        await queue.start()
+        await queue.send(OWNER, media_files, "deleted")
+        await db.delete_messages(OWNER, CHAT, [1])
+        assert os.path.exists(media_path)
+
+        release.set()
+        await queue.stop()
+        assert delivered == [[True]]
+        assert not os.path.exists(media_path)
+        assert await db.get_media_paths() == []
+        assert await db.get_notifications() == []
+
+    run_storage(scenario)
+
+def test_digest_chunks_repeat_header(run_storage):
+    header = "🧾 Activity of @alice:\n\n"
+    sent = []
+
+    async def scenario(db):
+        queue = Notifier(None, db)
+
+        async def fake_send(owner_id, media_files, text):
+            sent.append(text)
+
+        queue.send = fake_send
+        for message_id in range(40):
+            queue.add_digest(OWNER, (CHAT, 42), header, message_id, f"🗑 /{message_id}", "word " * 100)
+        await queue._flush_digest((OWNER, (CHAT, 42)))
+
+    run_storage(scenario)
+
+    assert len(sent) > 1
+    for index, chunk in enumerate(sent, 1):
+        assert chunk.startswith(f"🧾 Activity of @alice: \\({index}/{len(sent)}\\)\n\n")
+        assert len(chunk) <= MESSAGE_LIMIT
+    assert sum(chunk.count("🗑") for chunk in sent) == 40
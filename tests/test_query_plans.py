@@ -0,0 +1,108 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database import Database
+
+OWNER = 77
+CHAT = 42
+FULL_SCAN_TARGETS = {"messages", "message_actions", "media_files", "media_store", "users", "username_history", "m", "ma", "mf", "u", "h"}
+
+def _explain(db_path: str, statements):
+    conn = sqlite3.connect(db_path)
+    plans = []
+    try:
+        for sql in statements:
+            sql = sql.strip()
+            if sql.upper().startswith("CREATE TEMP"):
+                conn.execute(sql)
+            elif sql.split(None, 1)[0].upper() in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE") and "_fts_" not in sql:
+                plans.append((sql, [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]))
+    finally:
+        conn.close()
+    return plans
+
+@pytest.fixture
+def query_plans(tmp_path, monkeypatch, make_message):
+    monkeypatch.chdir(tmp_path)
+    db_path = str(tmp_path / "messages.db")
+
+    async def main():
+        db = Database(db_path)
+        await db.connect()
+        db.message_cache.max_entries = 0
+        for message_id in range(1, 4):
+            await db.save_message(OWNER, make_message(message_id, f"text {message_id}", photo="p" if message_id == 1 else None))
+        await db.save_message_action(OWNER, CHAT, 1, 'edit', "text 1", "edited")
+        await db.delete_messages(OWNER, CHAT, [2])
+        await db.flush()
+        _, actions = await db.get_user_actions(OWNER, "alice")
+
+        calls = {
+            "get_messages": lambda: db.get_messages(OWNER, CHAT, [1, 3]),
+            "get_edit_history": lambda: db.get_edit_history(OWNER, CHAT, 1),
+            "get_message_history": lambda: db.get_message_history(OWNER, 1),
+            "search_messages": lambda: db.search_messages(OWNER, "edited"),
+            "resolve_user": lambda: db.resolve_user(OWNER, "alice"),
+            "get_username": lambda: db.get_username(42),
+            "get_user_actions": lambda: db.get_user_actions(OWNER, "alice"),
+            "get_user_actions_before": lambda: db.get_user_actions(OWNER, "alice", before=actions[0][0]),
+            "get_user_actions_after": lambda: db.get_user_actions(OWNER, "alice", after=actions[-1][0]),
+            "get_user_stats": lambda: db.get_user_stats(OWNER, "alice"),
+            "get_stats": lambda: db.get_stats(OWNER),
+            "save_message_action": lambda: db.save_message_action(OWNER, CHAT, 3, 'edit', "text 3", "changed"),
+            "delete_messages": lambda: db.delete_messages(OWNER, CHAT, [3]),
+            "set_media_status": lambda: db.set_media_status("media/missing.jpg", 'done', 10),
+            "rename_media_path": lambda: db.rename_media_path("media/missing.jpg", "media/renamed.jpg"),
+            "get_pending_media": lambda: db.get_pending_media(),
+            "cleanup_user_data": lambda: db.cleanup_user_data(OWNER, "alice"),
+            "cleanup_old_messages": lambda: db.cleanup_old_messages(hours=0)
+        }
+
+        statements = {}
+        connections = [db.pool._writer, *db.pool._readers.queue]
+        for name, call in calls.items():
+            captured = statements[name] = []
+            for conn in connections:
+                conn.set_trace_callback(captured.append)
+            await call()
+            await db.flush()
+        for conn in connections:
+            conn.set_trace_callback(None)
+        await db.close()
+        return statements
+
+    return {name: _explain(db_path, captured) for name, captured in asyncio.run(main()).items()}
+
+def _details(plans):
+    return [detail for _, plan in plans for detail in plan]
+
+def test_no_full_table_scans(query_plans):
+    for name, plans in query_plans.items():
+        for sql, plan in plans:
+            scans = [detail for detail in plan if detail.startswith("SCAN ") and detail.split()[1] in FULL_SCAN_TARGETS]
+            assert not scans, f"{name}: {' '.join(sql.split())} -> {plan}"
+
+@pytest.mark.parametrize("name, expected", [
+    ("get_messages", "SEARCH m USING INDEX sqlite_autoindex_messages_1 (owner_id=? AND chat_id=? AND message_id=?)"),
+    ("get_messages", "SEARCH media_files USING INDEX idx_media_files_message (owner_id=? AND chat_id=? AND message_id=?)"),
+    ("get_edit_history", "SEARCH message_actions USING INDEX idx_message_actions_message (owner_id=? AND chat_id=? AND message_id=?)"),
+    ("get_message_history", "SEARCH m USING INDEX idx_messages_message_id (owner_id=? AND message_id=?)"),
+    ("search_messages", "SCAN messages_fts VIRTUAL TABLE INDEX 0:M1"),
+    ("resolve_user", "SEARCH h USING INDEX idx_username_history_username (username=?)"),
+    ("get_user_actions", "SEARCH ma USING INDEX idx_message_actions_user (owner_id=? AND user_id=?)"),
+    ("get_user_actions_before", "SEARCH ma USING INDEX idx_message_actions_user (owner_id=? AND user_id=? AND action_date<?)"),
+    ("get_user_actions_after", "SEARCH ma USING INDEX idx_message_actions_user (owner_id=? AND user_id=? AND action_date>?)"),
+    ("get_user_stats", "SEARCH s USING INDEX sqlite_autoindex_user_stats_1 (owner_id=? AND user_id=?)"),
+    ("get_stats", "SEARCH owner_stats USING INTEGER PRIMARY KEY (rowid=?)"),
+    ("set_media_status", "SEARCH media_files USING INDEX idx_media_files_path (media_path=?)"),
+    ("set_media_status", "SEARCH media_store USING INDEX idx_media_store_path (media_path=?)"),
+    ("rename_media_path", "SEARCH media_store USING INDEX idx_media_store_path (media_path=?)"),
+    ("get_pending_media", "SEARCH media_files USING INDEX idx_media_files_status (status=?)"),
+    ("cleanup_user_data", "SEARCH messages USING COVERING INDEX idx_messages_user_id (owner_id=? AND user_id=?)"),
+    ("cleanup_old_messages", "SEARCH messages USING INDEX idx_messages_date (date<?)"),
+    ("cleanup_old_messages", "SEARCH mf USING INDEX idx_media_files_message (owner_id=? AND chat_id=? AND message_id=?)"),
+])
+def test_query_uses_index(query_plans, name, expected):
+    assert any(expected in detail for detail in _details(query_plans[name])), _details(query_plans[name])
@@ -0,0 +1,178 @@
+OWNER = 77
+OTHER_OWNER = 88
+CHAT = 42
+
+def test_save_and_get_message(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, "first", photo="p1"))
+        await db.save_message(OTHER_OWNER, make_message(1, "other owner"))
+
+        message = await db.get_message(OWNER, CHAT, 1)
+        assert message["text"] == "first"
+        assert message["username"] == "alice"
+        assert [media_type for media_type, _, _ in message["media_files"]] == ["photo"]
+        assert (await db.get_message(OTHER_OWNER, CHAT, 1))["text"] == "other owner"
+        assert await db.get_message(OWNER, CHAT, 2) is None
+
+    run_storage(scenario)
+
+def test_edit_updates_text_and_history(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, "before"))
+        await db.save_message_action(OWNER, CHAT, 1, 'edit', "before", "after")
+
+        assert (await db.get_message(OWNER, CHAT, 1))["text"] == "after"
+        assert [text for text, _ in await db.get_edit_history(OWNER, CHAT, 1)] == ["before"]
+
+        history = await db.get_message_history(OWNER, 1)
+        assert history["original_text"] == "before"
+        assert [(action, old, new) for action, old, new, _ in history["actions"]] == [('edit', "before", "after")]
+
+    run_storage(scenario)
+
+def test_delete_records_action(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, "gone"))
+        await db.save_message(OWNER, make_message(2, "kept"))
+        await db.delete_messages(OWNER, CHAT, [1])
+
+        user_id, actions = await db.get_user_actions(OWNER, "alice")
+        assert user_id == 42
+        assert [(action, text, message_id) for _, action, text, _, _, _, _, message_id, _, _ in actions] == [('deleted', "gone", 1)]
+
+    run_storage(scenario)
+
+def test_media_refcounts(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, "a", photo="shared"))
+        await db.save_message(OWNER, make_message(2, "b", photo="shared", user_id=43, username="bob"))
+        await db.flush()
+        assert [file_unique_id for _, file_unique_id in await db.get_media_paths()] == ["unique-shared"]
+
+        await db.cleanup_user_data(OWNER, "alice")
+        assert [file_unique_id for _, file_unique_id in await db.get_media_paths()] == ["unique-shared"]
+
+        await db.cleanup_user_data(OWNER, "bob")
+        assert await db.get_media_paths() == []
+
+    run_storage(scenario)
+
+def test_stats_follow_writes(run_storage, make_message):
+    async def scenario(db):
+        for message_id in range(1, 4):
+            await db.save_message(OWNER, make_message(message_id, photo="p" if message_id == 1 else None))
+        await db.save_message(OWNER, make_message(4, user_id=43, username="bob"))
+        await db.save_message_action(OWNER, CHAT, 2, 'edit', "hello", "edited")
+
+        stats = await db.get_stats(OWNER)
+        assert (stats["total_messages"], stats["total_media"]) == (4, 1)
+
+        user = await db.get_user_stats(OWNER, "@alice")
+        assert (user["user_id"], user["total_messages"], user["total_actions"], user["total_media"]) == (42, 3, 1, 1)
+        assert (await db.get_user_stats(OWNER, "42"))["username"] == "alice"
+        assert await db.get_user_stats(OWNER, "nobody") is None
+        assert await db.rebuild_stats() == 0
+
+    run_storage(scenario)
+
+def test_cleanup(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, photo="p1"))
+        await db.save_message(OWNER, make_message(2, user_id=43, username="bob"))
+        await db.save_message(OTHER_OWNER, make_message(3))
+
+        await db.cleanup_all(OWNER)
+        assert (await db.get_stats(OWNER))["total_messages"] == 0
+        assert await db.get_message(OWNER, CHAT, 1) is None
+        assert (await db.get_stats(OTHER_OWNER))["total_messages"] == 1
+
+        await db.cleanup_old_messages(hours=0)
+        assert (await db.get_stats(OTHER_OWNER))["total_messages"] == 0
+        assert await db.rebuild_stats() == 0
+
+    run_storage(scenario)
+
+def test_outbox(run_storage):
+    async def scenario(db):
+        first = await db.add_notification(OWNER, "message", [("photo", "media/a.jpg", "file")], "one")
+        second = await db.add_notification(OTHER_OWNER, "album", [], "two")
+        await db.delete_notification(first)
+        return second
+
+    second = run_storage(scenario)
+
+    async def reopened(db):
+        if db.outbox_lease:
+            await db.pool.execute("UPDATE outbox SET claimed_at = now() - make_interval(secs => $1)", db.outbox_lease + 1)
+        assert await db.get_notifications() == [(second, OTHER_OWNER, "album", [], "two")]
+
+    run_storage(reopened, reset=False)
+
+def test_settings_persist(run_storage):
+    async def scenario(db):
+        await db.toggle_setting(OWNER, "notify_edited")
+        await db.set_ignore_changes_below(OWNER, 5)
+        await db.toggle_user_notify(OWNER, 43)
+        await db.save_connection("connection", OWNER)
+
+    run_storage(scenario)
+
+    async def reopened(db):
+        assert db.get_settings(OWNER) == {"notify_edited": False, "notify_deleted": True, "ignore_changes_below": 5, "digest_mode": False}
+        assert db.get_settings(OTHER_OWNER)["notify_edited"] is True
+        assert db.get_user_notify(OWNER, 43) is False
+        assert db.get_user_notify(OTHER_OWNER, 43) is True
+        assert db.get_connection_owner("connection") == OWNER
+
+    run_storage(reopened, reset=False)
+
+def test_users_are_scoped_to_owner(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, user_id=42, username="alice"))
+        await db.save_message(OTHER_OWNER, make_message(2, user_id=43, username="bob"))
+        await db.flush()
+
+        assert await db.get_user_stats(OWNER, "bob") is None
+        assert await db.get_user_stats(OWNER, "43") is None
+        assert await db.get_user_actions(OWNER, "bob") == (None, [])
+        assert await db.cleanup_user_data(OWNER, "bob") == (0, 0)
+        assert (await db.get_stats(OTHER_OWNER))["total_messages"] == 1
+        assert (await db.get_user_stats(OTHER_OWNER, "bob"))["user_id"] == 43
+
+    run_storage(scenario)
+
+def test_disabled_connections_are_cached(run_storage):
+    async def scenario(db):
+        await db.save_connection("disabled", OWNER, is_enabled=False)
+        assert db.has_connection("disabled")
+        assert db.get_connection_owner("disabled") is None
+        assert not db.has_connection("unknown")
+
+    run_storage(scenario)
+
+    async def reopened(db):
+        assert db.has_connection("disabled")
+        assert db.get_connection_owner("disabled") is None
+
+    run_storage(reopened, reset=False)
+
+def test_media_bytes_follow_store(run_storage, make_message):
+    async def scenario(db):
+        await db.save_message(OWNER, make_message(1, photo="p1"))
+        await db.save_message(OWNER, make_message(2, photo="p2", user_id=43, username="bob"))
+        await db.flush()
+        for media_path, _ in await db.get_media_paths():
+            await db.set_media_status(media_path, 'done', 10)
+
+        assert (await db.get_stats(OWNER))["media_bytes"] == 20
+        await db.cleanup_user_data(OWNER, "bob")
+        assert (await db.get_stats(OWNER))["media_bytes"] == 10
+
+    run_storage(scenario)
+
+    async def reopened(db):
+        assert db.media_bytes == 10
+        assert (await db.get_stats(OTHER_OWNER))["media_bytes"] == 10
+        assert await db.rebuild_stats() == 0
+
+    run_storage(reopened, reset=False)
@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+from utils import EDIT_DIAGONAL_LIMIT, chunk_markdown, edit_distance, escape_markdown, format_diff_quotes
+
+MARKDOWN_SPECIAL = set("\\_*[]()~`>#+-=|{}.!")
+TEXT_ALPHABET = "ab *~\\_.\n"
+
+def _levenshtein(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def _parse_quote(quote: str):
+    assert quote.startswith(">")
+    plain = []
+    styled = []
+    markers = set()
+    i = 1
+    while i < len(quote):
+        char = quote[i]
+        if char == "\\":
+            assert i + 1 < len(quote), quote
+            plain.append(quote[i + 1])
+            styled.append(bool(markers))
+            i += 2
+            continue
+        if char in "*~":
+            markers ^= {char}
+        else:
+            assert char not in MARKDOWN_SPECIAL, quote
+            if char == "\n":
+                assert not markers, quote
+            plain.append(char)
+            styled.append(bool(markers))
+        i += 1
+    assert not markers, quote
+    return "".join(plain), styled
+
+def _styled_text(plain: str, styled):
+    return "".join(char if is_styled else " " for char, is_styled in zip(plain, styled)).split()
+
+@pytest.mark.parametrize("limits", [range(1, EDIT_DIAGONAL_LIMIT + 1), range(EDIT_DIAGONAL_LIMIT + 1, 80)])
+def test_edit_distance_matches_levenshtein(limits):
+    rng = random.Random(limits.start)
+    for _ in range(500):
+        a = "".join(rng.choice("abc") for _ in range(rng.randrange(70)))
+        b = "".join(rng.choice("abc") for _ in range(rng.randrange(70)))
+        if rng.random() < 0.5:
+            b = a[:rng.randrange(len(a) + 1)] + b[:rng.randrange(6)] + a[rng.randrange(len(a) + 1):]
+        limit = rng.choice(limits)
+        assert edit_distance(a, b, limit) == min(_levenshtein(a, b), limit), (a, b, limit)
+
+def test_diff_quotes_escape_markers():
+    old_text = "price *was* 5~6 \\ ok"
+    new_text = "price *is* 7~8 \\ ok"
+    old_quote, new_quote = format_diff_quotes(old_text, new_text)
+
+    old_plain, old_styled = _parse_quote(old_quote)
+    new_plain, new_styled = _parse_quote(new_quote)
+    assert (old_plain, new_plain) == (old_text, new_text)
+    assert _styled_text(old_plain, old_styled) == ["*was*", "5~6"]
+    assert _styled_text(new_plain, new_styled) == ["*is*", "7~8"]
+    assert old_quote.startswith(">price ~\\*was\\*")
+
+def test_diff_quotes_multiline_spans():
+    old_text = "first line\nsecond one\ntwo\nlast"
+    new_text = "first line\nsecond uno\ndos\nlast"
+    old_quote, new_quote = format_diff_quotes(old_text, new_text)
+
+    old_plain, old_styled = _parse_quote(old_quote)
+    new_plain, new_styled = _parse_quote(new_quote)
+    assert (old_plain, new_plain) == (old_text, new_text)
+    assert "~one~\n~two~" in old_quote
+    assert _styled_text(old_plain, old_styled) == ["one", "two"]
+    assert _styled_text(new_plain, new_styled) == ["uno", "dos"]
+
+def test_diff_quotes_round_trip_random_text():
+    rng = random.Random(7)
+    for _ in range(500):
+        old_words = ["".join(rng.choice(TEXT_ALPHABET) for _ in range(rng.randrange(1, 6))) for _ in range(rng.randrange(1, 8))]
+        new_words = [word if rng.random() < 0.6 else "".join(rng.choice(TEXT_ALPHABET) for _ in range(rng.randrange(1, 6))) for word in old_words]
+        old_text, new_text = " ".join(old_words), " ".join(new_words)
+        if not old_text.strip() or not new_text.strip():
+            continue
+
+        old_quote, new_quote = format_diff_quotes(old_text, new_text)
+        assert _parse_quote(old_quote)[0] == old_text
+        assert _parse_quote(new_quote)[0] == new_text
+
+def test_chunk_markdown_keeps_escapes_whole():
+    rng = random.Random(11)
+    for _ in range(300):
+        parts = [
+            escape_markdown("".join(rng.choice(TEXT_ALPHABET) for _ in range(rng.randrange(1, 60))))
+            for _ in range(rng.randrange(1, 6))
+        ]
+        limit = rng.randrange(2, 40)
+        chunks = chunk_markdown(parts, limit)
+
+        assert "".join(chunks) == "".join(parts)
+        for chunk in chunks:
+            assert 0 < len(chunk) <= limit
+            assert (len(chunk) - len(chunk.rstrip("\\"))) % 2 == 0, chunks
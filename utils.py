@@ -1,8 +1,24 @@
 from aiogram import Bot, types
 from aiogram.types import FSInputFile
 import os
+import re
+import asyncio
+import hashlib
+from difflib import SequenceMatcher
 from datetime import datetime
 
+MEDIA_DIR = "media"
+MESSAGE_LIMIT = 4096
+ALBUM_SIZE = 10
+EDIT_DIAGONAL_LIMIT = 32
+ALBUM_KINDS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+INPUT_MEDIA = {
+    "photo": types.InputMediaPhoto,
+    "video": types.InputMediaVideo,
+    "document": types.InputMediaDocument,
+    "audio": types.InputMediaAudio
+}
+
 def escape_markdown(text: str) -> str:
     if not text:
         return ""
@@ -20,22 +36,219 @@ def format_as_quote(text: str) -> str:
     text = escape_markdown(text)
     return f">{text}"
 
-async def download_media(bot: Bot, file_id: str, path: str):
-    if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
+def shorten_quote(text: str, limit: int) -> str:
+    cut = len(text or "")
+    quote = format_as_quote(text)
+    while len(quote) > limit and cut > 0:
+        cut = min(cut - 1, cut * (limit - 1) // len(quote))
+        quote = format_as_quote(text[:cut] + "…")
+    return quote
+
+def _common_length(a: str, i: int, b: str, j: int) -> int:
+    limit = min(len(a) - i, len(b) - j)
+    if limit <= 0 or a[i] != b[j]:
+        return 0
+    low, high = 1, 2
+    while high <= limit and a[i:i + high] == b[j:j + high]:
+        low, high = high, high * 2
+    high = min(high, limit + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[i:i + middle] == b[j:j + middle]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+def _diagonal_distance(a: str, b: str, limit: int) -> int:
+    n, m = len(a), len(b)
+    target = m - n
+    previous = {0: _common_length(a, 0, b, 0)}
+    if target == 0 and previous[0] == n:
+        return 0
+
+    for errors in range(1, limit):
+        current = {}
+        for diagonal in range(max(-errors, -n), min(errors, m) + 1):
+            row = max(
+                previous.get(diagonal, -1) + 1,
+                previous.get(diagonal + 1, -1) + 1,
+                previous.get(diagonal - 1, -1)
+            )
+            row = min(row, n, m - diagonal)
+            if row < max(0, -diagonal):
+                continue
+            row += _common_length(a, row, b, row + diagonal)
+            if diagonal == target and row == n:
+                return errors
+            current[diagonal] = row
+        previous = current
+    return limit
+
+def _bit_parallel_distance(a: str, b: str, limit: int) -> int:
+    masks = {}
+    for i, char in enumerate(a):
+        masks[char] = masks.get(char, 0) | (1 << i)
+
+    full = (1 << len(a)) - 1
+    high = 1 << (len(a) - 1)
+    positive, negative = full, 0
+    score = len(a)
+    remaining = len(b)
+    for char in b:
+        match = masks.get(char, 0)
+        vertical = match | negative
+        horizontal = (((match & positive) + positive) ^ positive) | match
+        plus = negative | (~(horizontal | positive) & full)
+        minus = positive & horizontal
+        if plus & high:
+            score += 1
+        elif minus & high:
+            score -= 1
+        remaining -= 1
+        if score - remaining >= limit:
+            return limit
+        plus = ((plus << 1) | 1) & full
+        minus = (minus << 1) & full
+        positive = minus | (~(vertical | plus) & full)
+        negative = plus & vertical
+    return min(score, limit)
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    if abs(len(a) - len(b)) >= limit:
+        return limit
+
+    prefix = _common_length(a, 0, b, 0)
+    a, b = a[prefix:], b[prefix:]
+    suffix = _common_length(a[::-1], 0, b[::-1], 0)
+    a, b = a[:len(a) - suffix], b[:len(b) - suffix]
+    if not a or not b:
+        return min(len(a) + len(b), limit)
+
+    if limit <= EDIT_DIAGONAL_LIMIT:
+        return _diagonal_distance(a, b, limit)
+    return _bit_parallel_distance(a, b, limit)
+
+def _diff_tokens(text: str):
+    return re.findall(r'\s*\S+\s*|\s+', text)
+
+def _mark(text: str, marker: str) -> str:
+    lines = []
+    for line in text.split("\n"):
+        core = line.strip()
+        if core:
+            start = line.index(core)
+            line = f"{line[:start]}{marker}{escape_markdown(core)}{marker}{line[start + len(core):]}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def format_diff_quotes(old_text: str, new_text: str):
+    old_tokens = _diff_tokens(old_text or "")
+    new_tokens = _diff_tokens(new_text or "")
+    prefix = 0
+    while prefix < min(len(old_tokens), len(new_tokens)) and old_tokens[prefix] == new_tokens[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(old_tokens), len(new_tokens)) - prefix and old_tokens[-suffix - 1] == new_tokens[-suffix - 1]:
+        suffix += 1
+
+    old_end, new_end = len(old_tokens) - suffix, len(new_tokens) - suffix
+    matcher = SequenceMatcher(None, old_tokens[prefix:old_end], new_tokens[prefix:new_end])
+    opcodes = [('equal', 0, prefix, 0, prefix)] if prefix else []
+    opcodes += [(tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix) for tag, i1, i2, j1, j2 in matcher.get_opcodes()]
+    if suffix:
+        opcodes.append(('equal', old_end, len(old_tokens), new_end, len(new_tokens)))
+    if not any(tag == 'equal' for tag, *_ in opcodes):
+        return format_as_quote(old_text), format_as_quote(new_text)
+
+    old_parts = []
+    new_parts = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        old_span = "".join(old_tokens[i1:i2])
+        new_span = "".join(new_tokens[j1:j2])
+        if tag == 'equal':
+            old_parts.append(escape_markdown(old_span))
+            new_parts.append(escape_markdown(new_span))
+        else:
+            old_parts.append(_mark(old_span, "~"))
+            new_parts.append(_mark(new_span, "*"))
+    return f">{''.join(old_parts)}", f">{''.join(new_parts)}"
+
+def _split_markdown(text: str, limit: int):
+    while len(text) > limit:
+        cut = limit
+        if (cut - len(text[:cut].rstrip('\\'))) % 2:
+            cut -= 1
+        yield text[:cut]
+        text = text[cut:]
+    yield text
+
+def chunk_markdown(parts, limit: int = MESSAGE_LIMIT):
+    chunks = []
+    current = ""
+    for part in parts:
+        for piece in _split_markdown(part, limit):
+            if len(current) + len(piece) > limit:
+                chunks.append(current)
+                current = ""
+            current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _part_header(header: str, index: int, total: int) -> str:
+    if total == 1:
+        return header
+    title = header.rstrip()
+    return f"{title} \\({index}/{total}\\){header[len(title):]}"
+
+def chunk_digest(header: str, parts, limit: int = MESSAGE_LIMIT):
+    total = 1
+    while True:
+        chunks = chunk_markdown(parts, limit - len(_part_header(header, total, total)))
+        if len(chunks) <= total:
+            break
+        total = len(chunks)
+    return [_part_header(header, index, len(chunks)) + chunk for index, chunk in enumerate(chunks, 1)]
+
+def media_path_for(key: str, extension: str) -> str:
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return f"{MEDIA_DIR}/{digest[:2]}/{digest[2:4]}/{key}{extension}"
+
+class MediaTooLarge(Exception):
+    pass
+
+def _remove_partial(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+async def download_media(bot: Bot, file_id: str, path: str, max_size: int = None, chunk_size: int = 65536):
+    await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
     
     file = await bot.get_file(file_id)
-    await bot.download_file(file.file_path, path)
+    if max_size is not None and file.file_size and file.file_size > max_size:
+        raise MediaTooLarge(f"{file.file_size} bytes exceeds the {max_size} bytes limit")
+    
+    partial_path = f"{path}.part"
+    try:
+        await bot.download_file(file.file_path, partial_path, chunk_size=chunk_size)
+        await asyncio.to_thread(os.replace, partial_path, path)
+    except BaseException:
+        await asyncio.to_thread(_remove_partial, partial_path)
+        raise
     return path
 
-async def save_message(bot: Bot, message: types.Message, db):
-    if str(message.from_user.id) == os.getenv("USER_ID"):
+async def save_message(bot: Bot, owner_id: int, message: types.Message, db, downloader=None):
+    if message.from_user.id == owner_id:
         return
         
-    saved_media = await db.save_message(message)
+    saved_media = await db.save_message(owner_id, message)
     
-    for media_path, file_id in saved_media:
-        await download_media(bot, file_id, media_path)
+    for media_path, file_id, file_size, media_type in saved_media:
+        if downloader:
+            downloader.submit(media_path, file_id, file_size, media_type)
+        else:
+            await download_media(bot, file_id, media_path)
 
 async def collect_media_from_message(bot: Bot, message: types.Message):
     media_files = []
@@ -82,10 +295,15 @@ async def collect_media_from_message(bot: Bot, message: types.Message):
         
     return media_files
 
-async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=None):
+async def _input_file(media_path: str, file_id: str):
+    if media_path and await asyncio.to_thread(os.path.exists, media_path):
+        return types.FSInputFile(media_path)
+    return file_id
+
+async def send_media_message(bot: Bot, chat_id: int, media_files, text, reply_to_message_id=None):
     if not media_files:
         await bot.send_message(
-            chat_id=os.getenv("USER_ID"),
+            chat_id=chat_id,
             text=text,
             parse_mode="MarkdownV2",
             reply_to_message_id=reply_to_message_id
@@ -93,13 +311,14 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
         return True
     
     for media_type, media_path, file_id in media_files:
-        if media_type != "sticker" and not os.path.exists(media_path):
+        media = await _input_file(media_path, file_id)
+        if not media:
             continue
             
         if media_type == "photo":
             await bot.send_photo(
-                chat_id=os.getenv("USER_ID"),
-                photo=types.FSInputFile(media_path),
+                chat_id=chat_id,
+                photo=media,
                 caption=text,
                 parse_mode="MarkdownV2",
                 show_caption_above_media=True,
@@ -108,8 +327,8 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "video":
             await bot.send_video(
-                chat_id=os.getenv("USER_ID"),
-                video=types.FSInputFile(media_path),
+                chat_id=chat_id,
+                video=media,
                 caption=text,
                 parse_mode="MarkdownV2",
                 show_caption_above_media=True,
@@ -118,12 +337,12 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "video_note":
             video_note_message = await bot.send_video_note(
-                chat_id=os.getenv("USER_ID"),
-                video_note=types.FSInputFile(media_path),
+                chat_id=chat_id,
+                video_note=media,
                 reply_to_message_id=reply_to_message_id
             )
             await bot.send_message(
-                chat_id=os.getenv("USER_ID"),
+                chat_id=chat_id,
                 text=text,
                 parse_mode="MarkdownV2",
                 reply_to_message_id=video_note_message.message_id
@@ -131,8 +350,8 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "voice":
             await bot.send_voice(
-                chat_id=os.getenv("USER_ID"),
-                voice=types.FSInputFile(media_path),
+                chat_id=chat_id,
+                voice=media,
                 caption=text,
                 parse_mode="MarkdownV2",
                 reply_to_message_id=reply_to_message_id
@@ -140,8 +359,8 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "audio":
             await bot.send_audio(
-                chat_id=os.getenv("USER_ID"),
-                audio=types.FSInputFile(media_path),
+                chat_id=chat_id,
+                audio=media,
                 caption=text,
                 parse_mode="MarkdownV2",
                 reply_to_message_id=reply_to_message_id
@@ -149,7 +368,7 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "animation":
             await bot.send_animation(
-                chat_id=os.getenv("USER_ID"),
+                chat_id=chat_id,
                 animation=file_id,
                 caption=text,
                 parse_mode="MarkdownV2",
@@ -159,8 +378,8 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "document":
             await bot.send_document(
-                chat_id=os.getenv("USER_ID"),
-                document=types.FSInputFile(media_path),
+                chat_id=chat_id,
+                document=media,
                 caption=text,
                 parse_mode="MarkdownV2",
                 reply_to_message_id=reply_to_message_id
@@ -168,12 +387,12 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
         elif media_type == "sticker":
             sticker_message = await bot.send_sticker(
-                chat_id=os.getenv("USER_ID"),
+                chat_id=chat_id,
                 sticker=file_id,
                 reply_to_message_id=reply_to_message_id
             )
             await bot.send_message(
-                chat_id=os.getenv("USER_ID"),
+                chat_id=chat_id,
                 text=text,
                 parse_mode="MarkdownV2",
                 reply_to_message_id=sticker_message.message_id
@@ -181,9 +400,48 @@ async def send_media_message(bot: Bot, media_files, text, reply_to_message_id=No
             return True
             
     await bot.send_message(
-        chat_id=os.getenv("USER_ID"),
+        chat_id=chat_id,
         text=text,
         parse_mode="MarkdownV2",
         reply_to_message_id=reply_to_message_id
     )
-    return True 
\ No newline at end of file
+    return True 
+
+async def send_media_group_message(bot: Bot, chat_id: int, media_files, text, reply_to_message_id=None):
+    groups = {}
+    for media_file in media_files:
+        if media_file[0] in ALBUM_KINDS:
+            groups.setdefault(ALBUM_KINDS[media_file[0]], []).append(media_file)
+
+    chunks = [
+        group[start:start + ALBUM_SIZE]
+        for group in groups.values()
+        for start in range(0, len(group), ALBUM_SIZE)
+    ]
+    if not chunks:
+        return await send_media_message(bot, chat_id, [], text, reply_to_message_id)
+
+    caption = text
+    for chunk in chunks:
+        if len(chunk) == 1:
+            await send_media_message(bot, chat_id, chunk, caption or "", reply_to_message_id)
+            caption = None
+            continue
+
+        album = []
+        for media_type, media_path, file_id in chunk:
+            options = {}
+            if caption:
+                options = {"caption": caption, "parse_mode": "MarkdownV2"}
+                if ALBUM_KINDS[media_type] == "visual":
+                    options["show_caption_above_media"] = True
+                caption = None
+            album.append(INPUT_MEDIA[media_type](media=await _input_file(media_path, file_id), **options))
+
+        await bot.send_media_group(
+            chat_id=chat_id,
+            media=album,
+            reply_to_message_id=reply_to_message_id
+        )
+
+    return True
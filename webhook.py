@@ -0,0 +1,48 @@
+import asyncio
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+class ConcurrencyLimit(BaseMiddleware):
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit) if limit else None
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.in_flight = 0
+
+    async def __call__(self, handler, event, data):
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            if self._semaphore is None:
+                return await handler(event, data)
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float = 30):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def build_app(dp: Dispatcher, bot: Bot, limiter: ConcurrencyLimit, path: str, secret: str = None,
+              handle_in_background: bool = True, drain_timeout: float = 30):
+    app = web.Application()
+
+    async def drain(app):
+        await limiter.wait_idle(drain_timeout)
+
+    app.on_shutdown.append(drain)
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+        handle_in_background=handle_in_background
+    ).register(app, path=path)
+    return app